@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+"""Time ``disk_tree.s3.agg_dirs`` (vectorized directory expansion + aggregation) on synthetic S3 listings, and check it
+against the original ``iterrows`` / per-row-DataFrame implementation (too slow to run at full size) on a sample."""
+from os.path import join
+
+import numpy as np
+import pandas as pd
+from click import command, option
+from time import perf_counter
+from utz import concat, DF, dirname, sxs
+
+from disk_tree.s3 import agg_dirs
+from disk_tree.tree import STR
+
+
+def make_files(n, depth, fanout, root_key, rng):
+    """``n`` files under ``root_key``, each in a random directory of depth ``[0, depth]``, with ``fanout``
+    subdirectories per level (in the form ``Cache.compute_s3`` passes to ``agg_dirs``)."""
+    depths = rng.integers(0, depth + 1, n)
+    relpaths = np.full(n, '', dtype=STR)
+    for level in range(depth):
+        components = np.strings.add(np.strings.add('d', rng.integers(0, fanout, n).astype(STR)), '/')
+        relpaths = np.where(depths > level, np.strings.add(relpaths, components), relpaths)
+    relpaths = np.strings.add(relpaths, np.strings.add('f', np.arange(n).astype(STR))).astype(object)
+    files = DF({
+        'relpath': relpaths,
+        'size': rng.integers(0, 1 << 30, n),
+        'mtime': pd.to_datetime(rng.integers(1_500_000_000, 1_700_000_000, n), unit='s'),
+    })
+    files['key'] = f'{root_key}/' + files['relpath'] if root_key else files['relpath']
+    files['root_key'] = root_key
+    return files
+
+
+def dirs(file):
+    rv = []
+    cur = file
+    while True:
+        dir = dirname(cur)
+        if dir == cur:
+            break
+        else:
+            rv.append(dir)
+            cur = dir
+    return list(reversed(rv))
+
+
+def expand_file_row(r):
+    file_df = r.to_frame().transpose()
+    ancestors = dirs(r.relpath)
+    dirs_df = DF([
+        {
+            **r.to_dict(),
+            'key': join(r.root_key, dir) if dir else r.root_key,
+            'kind': 'dir',
+        }
+        for dir in ancestors
+    ])
+    return concat([file_df, dirs_df]).reset_index(drop=True)
+
+
+def agg_dirs_legacy(files, k='key'):
+    """The original ``s3.agg_dirs``."""
+    files['kind'] = 'file'
+    expanded = concat([ expand_file_row(row) for _, row in files.iterrows() ])
+    groups = expanded.groupby([k, 'kind'])
+    sizes = groups['size'].sum()
+    mtimes = groups['mtime'].max()
+    num_descendants = groups.size().rename('num_descendants')
+    return sxs(mtimes, sizes, num_descendants).reset_index()
+
+
+def normalize(aggd):
+    aggd = aggd[[ 'key', 'kind', 'size', 'mtime', 'num_descendants' ]].sort_values([ 'key', 'kind' ]).reset_index(drop=True)
+    return aggd.astype({ 'size': 'int64', 'num_descendants': 'int64', 'mtime': 'datetime64[ns]', 'kind': object })
+
+
+@command()
+@option('-c', '--check', 'num_check', default=2000, help='Number of keys to compare against the original implementation on; default: 2000')
+@option('-d', '--depth', default=6, help='Max directory depth of keys; default: 6')
+@option('-f', '--fanout', default=10, help='Subdirectories per directory; default: 10')
+@option('-n', '--num-keys', 'sizes', multiple=True, type=float, help='Number of keys to aggregate (can be passed multiple times); default: 1e6, 1e7')
+@option('-r', '--root-key', default='root', help='Prefix that keys are listed under; default: "root"')
+@option('-s', '--seed', default=0, help='Random seed; default: 0')
+def main(num_check, depth, fanout, sizes, root_key, seed):
+    rng = np.random.default_rng(seed)
+    if num_check:
+        files = make_files(num_check, depth, fanout, root_key, rng)
+        start = perf_counter()
+        expected = normalize(agg_dirs_legacy(files.copy()))
+        legacy_elapsed = perf_counter() - start
+        start = perf_counter()
+        actual = normalize(agg_dirs(files.copy()))
+        elapsed = perf_counter() - start
+        pd.testing.assert_frame_equal(actual, expected)
+        print(f'{num_check} keys: original {legacy_elapsed:.2f}s, vectorized {elapsed:.3f}s ({legacy_elapsed / elapsed:.0f}x); outputs match')
+
+    for n in sizes or [ 1e6, 1e7 ]:
+        n = int(n)
+        files = make_files(n, depth, fanout, root_key, rng)
+        start = perf_counter()
+        aggd = agg_dirs(files)
+        elapsed = perf_counter() - start
+        num_dirs = (aggd.kind == 'dir').sum()
+        print(f'{n} keys: {elapsed:.2f}s ({n / elapsed:.0f} keys/s), {num_dirs} dirs')
+
+
+if __name__ == '__main__':
+    main()
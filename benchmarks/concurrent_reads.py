@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+"""Time renders (as ``disk-tree -r/--read-only`` does them: a cached subtree's rows, loaded into a ``Tree``) from ``-r``
+reader processes, each with its own read-only connection, while another process rescans (rewriting every row of) a
+synthetic tree of ``-n`` files in the same DB, under each storage profile (``db.PROFILES``).
+
+Reads are reported separately for before the scan starts ("idle") and while it runs."""
+from os.path import dirname, join, normpath
+
+import numpy as np
+import os
+import pandas as pd
+from click import command, option
+from multiprocessing import get_context
+from tempfile import TemporaryDirectory
+from time import monotonic, perf_counter, sleep
+
+from agg_dirs import make_files
+
+
+def make_tree(root, n, depth, fanout, seed):
+    """``n`` empty files under ``root``, in random directories (as in ``make_files``)."""
+    files = make_files(n, depth, fanout, '', np.random.default_rng(seed))
+    for relpath in files['relpath']:
+        path = join(root, relpath)
+        os.makedirs(dirname(path), exist_ok=True)
+        open(path, 'w').close()
+
+
+def scan(db_path, profile_name, root, batch_size=None):
+    """Scan ``root`` (rewriting any cached rows), in a process of its own."""
+    from disk_tree.db import init, migrate
+    db = init(db_path, profile_name=profile_name)
+    from disk_tree.cache import Cache
+    db.create_all()
+    migrate()
+    Cache(ttl=pd.Timedelta(0), batch_size=batch_size).compute_file(root)
+
+
+def read(db_path, profile_name, path, interval, ready, stop, results):
+    """Render ``path`` from the cache every ``interval`` seconds, until ``stop`` is set; put ``(start, latency)``
+    tuples (``monotonic`` times, so they're comparable across processes) and a count of failed reads on ``results``."""
+    from disk_tree.db import init
+    db = init(db_path, read_only=True, profile_name=profile_name)
+    from disk_tree.cache import Cache
+    from sqlalchemy.exc import OperationalError
+    cache = Cache()
+    reads = []
+    errors = 0
+    ready.set()
+    while not stop.is_set():
+        start = monotonic()
+        try:
+            cache.tree(cache.node(path))
+            reads.append((start, monotonic() - start))
+        except OperationalError:
+            errors += 1
+        # End the read transaction (and drop the session's cached objects), as a separate render would
+        db.session.rollback()
+        sleep(interval)
+    results.put((reads, errors))
+
+
+def summarize(latencies):
+    if not latencies:
+        return '0 reads'
+    ms = np.array(latencies) * 1000
+    return f'{len(ms)} reads, median {np.median(ms):.1f}ms, p99 {np.percentile(ms, 99):.1f}ms, max {ms.max():.1f}ms'
+
+
+@command()
+@option('-b', '--batch-size', type=int, help='Rows per scan transaction (see `Cache`); default: 10000')
+@option('-d', '--depth', default=4, help='Max directory depth of files; default: 4')
+@option('-f', '--fanout', default=10, help='Subdirectories per directory; default: 10')
+@option('-i', '--interval', default=0.05, help='Seconds each reader waits between renders; default: 0.05')
+@option('-I', '--idle', default=2., help='Seconds to read for before starting the scan; default: 2')
+@option('-n', '--num-files', default=1e5, type=float, help='Number of files in the scanned tree; default: 1e5')
+@option('-p', '--profile', 'profiles', multiple=True, help='Storage profiles to compare (can be passed multiple times); default: all')
+@option('-r', '--num-readers', default=4, help='Number of reader processes; default: 4')
+@option('-R', '--render-path', default='d0', help='Subdirectory (of the scanned tree) that readers render ("." for all of it); default: "d0"')
+@option('-s', '--seed', default=0, help='Random seed; default: 0')
+def main(batch_size, depth, fanout, interval, idle, num_files, profiles, num_readers, render_path, seed):
+    from disk_tree.db import PROFILES
+    # Readers and writers each need their own process (and `disk_tree.db` state); don't fork this one's
+    ctx = get_context('spawn')
+    with TemporaryDirectory() as tmpdir:
+        root = join(tmpdir, 'tree')
+        start = perf_counter()
+        make_tree(root, int(num_files), depth, fanout, seed)
+        print(f'Created {int(num_files)} files under {root} in {perf_counter() - start:.1f}s')
+        for name in profiles or PROFILES:
+            db_path = join(tmpdir, f'{name}.db')
+            # Initial scan, so that readers have something to render while the tree is rescanned
+            writer = ctx.Process(target=scan, args=(db_path, name, root, batch_size))
+            writer.start()
+            writer.join()
+
+            stop = ctx.Event()
+            results = ctx.Queue()
+            readers = []
+            for _ in range(num_readers):
+                ready = ctx.Event()
+                reader = ctx.Process(target=read, args=(db_path, name, normpath(join(root, render_path)), interval, ready, stop, results))
+                reader.start()
+                ready.wait()
+                readers.append(reader)
+            sleep(idle)
+
+            writer = ctx.Process(target=scan, args=(db_path, name, root, batch_size))
+            scan_start = monotonic()
+            writer.start()
+            writer.join()
+            scan_end = monotonic()
+            stop.set()
+            reads, errors = [], 0
+            for _ in readers:
+                r, e = results.get()
+                reads += r
+                errors += e
+            for reader in readers:
+                reader.join()
+            idle_reads = [ latency for start, latency in reads if start < scan_start ]
+            scan_reads = [ latency for start, latency in reads if scan_start <= start < scan_end ]
+            print(f'{name}: rescan {scan_end - scan_start:.1f}s')
+            print(f'  idle: {summarize(idle_reads)}')
+            print(f'  during rescan: {summarize(scan_reads)}' + (f', {errors} failed' if errors else ''))
+
+
+if __name__ == '__main__':
+    main()
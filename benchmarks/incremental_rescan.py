@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+"""Time a full rescan vs. an incremental (``-i``/``--incremental``) rescan of a synthetic tree after modifying a
+fraction of its files, and count the directory listings and cache rows written by each."""
+from os.path import join
+
+import os
+import random
+from click import command, option
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from scan_syscalls import make_tree
+
+from disk_tree.db import init, migrate
+
+
+def churn(root, fraction, rng):
+    paths = [ join(dir, name) for dir, _, names in os.walk(root) for name in names ]
+    changed = rng.sample(paths, max(1, int(len(paths) * fraction)))
+    for path in changed:
+        with open(path, 'a') as f:
+            f.write('churn')
+    return len(paths), len(changed)
+
+
+@command()
+@option('-c', '--churn', 'fraction', default=0.001, help='Fraction of files to modify before each rescan; default: 0.001')
+@option('-d', '--depth', default=4, help='Directory nesting depth; default: 4')
+@option('-f', '--files', default=20, help='Files per directory; default: 20')
+@option('-n', '--fanout', default=6, help='Subdirectories per directory; default: 6')
+@option('-s', '--seed', default=0, help='Random seed for choosing modified files; default: 0')
+def main(fraction, depth, fanout, files, seed):
+    rng = random.Random(seed)
+    with TemporaryDirectory() as tmpdir:
+        root = join(tmpdir, 'tree')
+        os.mkdir(root)
+        make_tree(root, depth, fanout, files)
+        db = init(join(tmpdir, 'disk-tree.db'))
+        from disk_tree.cache import Cache
+        db.create_all()
+        migrate()
+        Cache(incremental=True).compute(root)
+
+        scandir = os.scandir
+        for incremental in [False, True]:
+            num_files, num_changed = churn(root, fraction, rng)
+            cache = Cache(incremental=incremental)
+            counts = dict(scandir=0, rows=0)
+
+            def counted_scandir(*args, **kwargs):
+                counts['scandir'] += 1
+                return scandir(*args, **kwargs)
+
+            extend = cache.writer.extend
+
+            def counted_extend(table, rows):
+                counts['rows'] += len(rows)
+                extend(table, rows)
+
+            cache.writer.extend = counted_extend
+            os.scandir = counted_scandir
+            try:
+                start = perf_counter()
+                cache.compute(root)
+                elapsed = perf_counter() - start
+            finally:
+                os.scandir = scandir
+            name = 'incremental' if incremental else 'full'
+            print(f'{name:>11}: {elapsed:.3f}s, {counts["scandir"]} listings, {counts["rows"]} rows written ({num_changed}/{num_files} files modified)')
+
+
+if __name__ == '__main__':
+    main()
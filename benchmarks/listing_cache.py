@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+"""Compare a synthetic listing's size on disk, and time to load it, as ``aws s3 ls --recursive`` text (parsed with
+``s3.read_listing``) vs. as a binary ``listing_cache`` (read with ``listing_cache.read``); also times the migration from
+the former to the latter."""
+from os.path import getsize, join
+
+import numpy as np
+from click import command, option
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from s3_listing import write_listing
+
+from disk_tree import listing_cache, s3
+
+
+def load(blocks):
+    return sum(len(files) for files in blocks)
+
+
+@command()
+@option('-d', '--depth', default=6, help='Max directory depth of keys; default: 6')
+@option('-f', '--fanout', default=10, help='Subdirectories per directory; default: 10')
+@option('-n', '--num-keys', default=1e6, type=float, help='Number of keys in the listing; default: 1e6')
+@option('-r', '--repeat', default=3, help='Number of times to time each load (reporting the fastest); default: 3')
+@option('-s', '--seed', default=0, help='Random seed; default: 0')
+def main(depth, fanout, num_keys, repeat, seed):
+    n = int(num_keys)
+    with TemporaryDirectory() as tmpdir:
+        txt_path = join(tmpdir, 'ls.txt')
+        path = join(tmpdir, 'ls.lsz')
+        write_listing(txt_path, n, depth, fanout, '', np.random.default_rng(seed))
+        # Listings are sorted by key (which front-coding relies on)
+        files = sorted(open(txt_path).read().splitlines(), key=lambda line: line[31:])
+        with open(txt_path, 'w') as f:
+            f.write('\n'.join(files))
+            f.write('\n')
+        del files
+        txt_size = getsize(txt_path)
+
+        start = perf_counter()
+        listing_cache.write(path, s3.read_listing(txt_path))
+        print(f'Migrated {n} keys in {perf_counter() - start:.2f}s: {txt_size / 2**20:.1f}MiB text -> {getsize(path) / 2**20:.1f}MiB binary')
+
+        for name, read in [ ('text', lambda: s3.read_listing(txt_path)), ('binary', lambda: listing_cache.read(path)) ]:
+            elapsed = None
+            for _ in range(repeat):
+                start = perf_counter()
+                num_loaded = load(read())
+                cur = perf_counter() - start
+                elapsed = cur if elapsed is None else min(elapsed, cur)
+            print(f'{name}: loaded {num_loaded} keys in {elapsed:.2f}s ({num_loaded / elapsed:.0f} keys/s)')
+
+
+if __name__ == '__main__':
+    main()
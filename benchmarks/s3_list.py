@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+"""Time the native, sharded ListObjectsV2 lister (``s3_list.Lister``) on a bucket, for various numbers of threads
+(each listing ``SHARDS_PER_JOB`` key-range shards, on average).
+
+Meant to run against a local S3 stand-in, e.g. ``moto_server -p 5555`` or MinIO, with ``AWS_ENDPOINT_URL`` set (and
+dummy credentials); ``-n`` populates the bucket with synthetic (empty) keys first."""
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+import numpy as np
+from click import command, option
+from time import perf_counter
+
+from agg_dirs import make_files
+
+from disk_tree.s3_list import Lister, SHARDS_PER_JOB
+
+
+def populate(client, bucket, n, depth, fanout, jobs, seed):
+    client.create_bucket(Bucket=bucket)
+    files = make_files(n, depth, fanout, '', np.random.default_rng(seed))
+    with ThreadPoolExecutor(jobs) as pool:
+        list(pool.map(lambda key: client.put_object(Bucket=bucket, Key=key, Body=b''), files['key']))
+
+
+@command()
+@option('-b', '--bucket', default='disk-tree-bench', help='Bucket to list; default: "disk-tree-bench"')
+@option('-d', '--depth', default=4, help='With -n: max directory depth of keys; default: 4')
+@option('-f', '--fanout', default=10, help='With -n: subdirectories per directory; default: 10')
+@option('-j', '--jobs', 'jobs_list', multiple=True, type=int, help='Number of threads to list with (can be passed multiple times); default: 1, 2, 4, 8, 16')
+@option('-n', '--num-keys', type=float, help='Create the bucket and populate it with this many keys first')
+@option('-p', '--prefix', default='', help='Prefix to list under')
+@option('-r', '--repeat', default=3, help='Number of times to time each setting (reporting the fastest); default: 3')
+@option('-s', '--seed', default=0, help='With -n: random seed; default: 0')
+def main(bucket, depth, fanout, jobs_list, num_keys, prefix, repeat, seed):
+    client = boto3.client('s3')
+    if num_keys:
+        start = perf_counter()
+        populate(client, bucket, int(num_keys), depth, fanout, 16, seed)
+        print(f'Populated s3://{bucket} with {int(num_keys)} keys in {perf_counter() - start:.1f}s')
+
+    for jobs in jobs_list or [ 1, 2, 4, 8, 16 ]:
+        elapsed = None
+        for _ in range(repeat):
+            start = perf_counter()
+            num_listed = sum(len(contents) for _, contents, _ in Lister(bucket, prefix, jobs=jobs, client=client))
+            cur = perf_counter() - start
+            elapsed = cur if elapsed is None else min(elapsed, cur)
+        print(f'{jobs} threads ({jobs * SHARDS_PER_JOB} shards): {num_listed} keys in {elapsed:.2f}s ({num_listed / elapsed:.0f} keys/s)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+"""Time parsing + aggregating a synthetic ``aws s3 ls --recursive`` listing with the streaming, block-at-a-time parser
+(``s3.read_listing`` + ``s3.DirTotals``), vs. reading the whole listing and parsing it line by line (as ``compute_s3``
+originally did), and report each one's peak RSS (each runs in its own subprocess)."""
+from os.path import join
+
+import json
+import numpy as np
+import pandas as pd
+import resource
+import subprocess
+import sys
+from click import command, option
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from agg_dirs import make_files
+
+from disk_tree import s3
+from disk_tree.tree import STR
+
+
+def write_listing(path, n, depth, fanout, root_key, rng):
+    files = make_files(n, depth, fanout, root_key, rng)
+    mtimes = files['mtime'].dt.strftime(s3.MTIME_FMT).to_numpy(dtype=STR)
+    sizes = np.strings.rjust(files['size'].to_numpy().astype(STR), 10)
+    lines = np.strings.add(np.strings.add(np.strings.add(np.strings.add(mtimes, ' '), sizes), ' '), files['key'].to_numpy(dtype=STR))
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines.tolist()))
+        f.write('\n')
+
+
+def aggregate(files, prefix, root_key):
+    files = files[~files.key.str.endswith('/')]
+    files['relpath'] = s3.strip_prefixes(files['key'], prefix)
+    files['root_key'] = root_key
+    return s3.agg_dirs(files)
+
+
+def run_streaming(path, root_key, block_size):
+    prefix = f'{root_key}/' if root_key else None
+    dirs = s3.DirTotals()
+    num_files = 0
+    for files in s3.read_listing(path, block_size):
+        aggd = aggregate(files, prefix, root_key)
+        is_dir = aggd.kind == 'dir'
+        num_files += (~is_dir).sum()
+        dirs.add(aggd[is_dir])
+    return num_files, len(dirs.total())
+
+
+def run_legacy(path, root_key, block_size):
+    with open(path, 'r') as f:
+        lines = [ line.rstrip('\n') for line in f.readlines() ]
+    files = pd.DataFrame([ s3.parse_line(line) for line in lines ])
+    aggd = aggregate(files, f'{root_key}/' if root_key else None, root_key)
+    is_dir = aggd.kind == 'dir'
+    return (~is_dir).sum(), is_dir.sum()
+
+
+MODES = { 'streaming': run_streaming, 'legacy': run_legacy }
+
+
+@command()
+@option('-b', '--block-size', default=s3.DEFAULT_BLOCK_SIZE, help=f'Characters of listing to parse at a time; default: {s3.DEFAULT_BLOCK_SIZE}')
+@option('-d', '--depth', default=6, help='Max directory depth of keys; default: 6')
+@option('-f', '--fanout', default=10, help='Subdirectories per directory; default: 10')
+@option('-L', '--no-legacy', is_flag=True, help="Skip the original (whole-listing, per-line) parser")
+@option('-n', '--num-keys', 'sizes', multiple=True, type=float, help='Number of keys in the listing (can be passed multiple times); default: 1e6')
+@option('-r', '--root-key', default='root', help='Prefix that keys are listed under; default: "root"')
+@option('-s', '--seed', default=0, help='Random seed; default: 0')
+@option('--run', nargs=2, hidden=True, help='Internal: run one mode on one listing, and print its stats as JSON')
+def main(block_size, depth, fanout, no_legacy, sizes, root_key, seed, run):
+    if run:
+        mode, path = run
+        start = perf_counter()
+        num_files, num_dirs = MODES[mode](path, root_key, block_size)
+        elapsed = perf_counter() - start
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        print(json.dumps(dict(elapsed=elapsed, peak=peak, num_files=int(num_files), num_dirs=int(num_dirs))))
+        return
+
+    rng = np.random.default_rng(seed)
+    modes = [ 'streaming' ] if no_legacy else [ 'streaming', 'legacy' ]
+    with TemporaryDirectory() as tmpdir:
+        for n in sizes or [ 1e6 ]:
+            n = int(n)
+            path = join(tmpdir, 'ls.txt')
+            write_listing(path, n, depth, fanout, root_key, rng)
+            for mode in modes:
+                cmd = [ sys.executable, __file__, '-b', str(block_size), '-r', root_key, '--run', mode, path ]
+                stats = json.loads(subprocess.check_output(cmd))
+                elapsed, peak = stats['elapsed'], stats['peak']
+                print(f'{n} keys, {mode}: {elapsed:.2f}s ({n / elapsed:.0f} keys/s), peak RSS {peak / 2**20:.0f}MiB, {stats["num_files"]} files in {stats["num_dirs"]} dirs')
+
+
+if __name__ == '__main__':
+    main()
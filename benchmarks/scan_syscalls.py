@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+"""Compare filesystem syscalls made by the ``os.scandir`` traversal (``disk_tree.scan.list_dir``) vs. the original
+``islink`` / ``isfile`` / ``isdir`` / ``os.stat`` / ``os.walk`` traversal, on a synthetic tree.
+
+Syscalls are counted by wrapping ``os.stat``, ``os.lstat`` and ``os.scandir`` (which ``os.path.is*`` and ``os.walk``
+call through), and ``DirEntry.stat`` (whose result is cached per entry, so only its first call hits the filesystem).
+"""
+from os import walk
+from os.path import isdir, isfile, islink, join
+
+import os
+from click import command, option
+from collections import Counter
+from contextlib import contextmanager
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from disk_tree.scan import list_dir
+
+
+def make_tree(root, depth, fanout, files):
+    for i in range(files):
+        with open(join(root, f'f{i}'), 'w') as f:
+            f.write('x' * i)
+    if depth:
+        for i in range(fanout):
+            d = join(root, f'd{i}')
+            os.mkdir(d)
+            make_tree(d, depth - 1, fanout, files)
+
+
+def walk_legacy(path):
+    """The pre-``scandir`` traversal from ``Cache.compute``, minus DB writes."""
+    if islink(path):
+        return 0
+    elif isfile(path):
+        return os.stat(path).st_size
+    elif isdir(path):
+        _, dirs, files = next(walk(path))
+        size = sum( walk_legacy(join(path, name)) for name in files + dirs )
+        os.stat(path)
+        return size
+    else:
+        raise RuntimeError(f'Unrecognized path type: {path}')
+
+
+def walk_scandir(path, stat):
+    names, file_stats, subdir_stats = list_dir(path)
+    return sum( s.st_size for _, s in file_stats ) + sum( walk_scandir(child, s) for child, s in subdir_stats )
+
+
+class CountingEntry:
+    def __init__(self, entry, counts):
+        self.entry = entry
+        self.counts = counts
+        self.stat_result = None
+
+    def __getattr__(self, name):
+        return getattr(self.entry, name)
+
+    def stat(self, *, follow_symlinks=True):
+        if self.stat_result is None:
+            self.counts['DirEntry.stat'] += 1
+            self.stat_result = self.entry.stat(follow_symlinks=follow_symlinks)
+        return self.stat_result
+
+
+class CountingScandir:
+    def __init__(self, it, counts):
+        self.it = it
+        self.counts = counts
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.it.close()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return CountingEntry(next(self.it), self.counts)
+
+    def close(self):
+        self.it.close()
+
+
+@contextmanager
+def count_syscalls(counts, wrap_entries):
+    stat, lstat, scandir = os.stat, os.lstat, os.scandir
+
+    def counted(name, fn):
+        def wrapper(*args, **kwargs):
+            counts[name] += 1
+            return fn(*args, **kwargs)
+        return wrapper
+
+    def counted_scandir(*args, **kwargs):
+        counts['scandir'] += 1
+        it = scandir(*args, **kwargs)
+        return CountingScandir(it, counts) if wrap_entries else it
+
+    os.stat, os.lstat, os.scandir = counted('stat', stat), counted('lstat', lstat), counted_scandir
+    try:
+        yield
+    finally:
+        os.stat, os.lstat, os.scandir = stat, lstat, scandir
+
+
+@command()
+@option('-d', '--depth', default=4, help='Directory nesting depth; default: 4')
+@option('-f', '--files', default=20, help='Files per directory; default: 20')
+@option('-n', '--fanout', default=5, help='Subdirectories per directory; default: 5')
+def main(depth, fanout, files):
+    with TemporaryDirectory() as root:
+        make_tree(root, depth, fanout, files)
+        results = {}
+        for name, fn, wrap_entries in [
+            ('legacy', lambda: walk_legacy(root), False),
+            ('scandir', lambda: walk_scandir(root, os.stat(root)), True),
+        ]:
+            counts = Counter()
+            with count_syscalls(counts, wrap_entries):
+                start = perf_counter()
+                size = fn()
+                elapsed = perf_counter() - start
+            results[name] = size
+            total = sum(counts.values())
+            print(f'{name:>8}: {total:8d} syscalls ({dict(counts)}), {elapsed:.3f}s')
+        if results['legacy'] != results['scandir']:
+            raise RuntimeError(f'Traversals disagree on total size: {results}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+"""Time fetching cached subtrees (as ``Node.tree_rows`` does) from a DB holding many roots' rows, with nested-interval
+(``Node.lo``/``hi``) predicates, and recursive CTEs over ``parent_id`` (``model.subtree_ids``, and ``model.subtree``,
+which also rebuilds each row's path; used for rows not yet numbered).
+
+The DB (``-p``, default: a temporary file) is populated with ``-n`` synthetic ``Node`` rows, across ``-r`` roots, unless
+it already holds rows (so a large DB can be built once, and re-timed)."""
+from os.path import dirname, join
+
+import numpy as np
+import random
+import sqlite3
+from click import command, option
+from tempfile import TemporaryDirectory
+from time import perf_counter, time_ns
+
+from agg_dirs import make_files
+
+
+def intervals(paths, base):
+    """Pre-order ``(lo, hi)`` of each of ``paths`` (a complete subtree), as ``Cache.number_subtree`` assigns them."""
+    keys = np.array([ path.replace('/', '\0') for path in paths ], dtype=object)
+    order = np.argsort(keys, kind='stable')
+    ends = np.searchsorted(keys[order], np.array([ f'{key}\1' for key in keys[order] ], dtype=object)) - 1
+    lo, hi = np.empty(len(paths), dtype=np.int64), np.empty(len(paths), dtype=np.int64)
+    lo[order] = base + np.arange(len(paths))
+    hi[order] = base + ends
+    return lo.tolist(), hi.tolist()
+
+
+def populate(path, n, num_roots, depth, fanout, seed):
+    rng = np.random.default_rng(seed)
+    now = time_ns()
+    conn = sqlite3.connect(path)
+    per_root = n // num_roots
+    sql = 'INSERT INTO node (id, parent_id, name, mtime, size, kind, num_descendants, checked_at, lo, hi) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'
+    # "/" and "/bench" are unnumbered (as if only the roots under them had been scanned)
+    conn.executemany(sql, [ (1, 0, '/', now, 0, 'dir', 0, now, None, None), (2, 1, 'bench', now, 0, 'dir', 0, now, None, None) ])
+    num_ids = 2
+    base = 0
+    for r in range(num_roots):
+        root = f'/bench/r{r}'
+        files = make_files(per_root, depth, fanout, root, rng)
+        keys = files['key'].tolist()
+        mtimes = files['mtime'].astype('datetime64[ns]').astype('int64').tolist()
+        ids = { '/bench': 2 }
+        dirs = []
+        for key in keys:
+            parent = dirname(key)
+            new = []
+            while parent not in ids:
+                new.append(parent)
+                parent = dirname(parent)
+            for dir in reversed(new):
+                num_ids += 1
+                ids[dir] = num_ids
+                dirs.append(dir)
+        for key in keys:
+            num_ids += 1
+            ids[key] = num_ids
+        lo, hi = intervals(dirs + keys, base)
+        base += len(dirs) + len(keys)
+        rows = [
+            (ids[p], ids[dirname(p)], p.rpartition('/')[2], now, 0, 'dir', 0, now, l, h)
+            for p, l, h in zip(dirs, lo, hi)
+        ] + [
+            (ids[p], ids[dirname(p)], p.rpartition('/')[2], mtime, size, 'file', 1, now, l, h)
+            for p, mtime, size, l, h in zip(keys, mtimes, files['size'].tolist(), lo[len(dirs):], hi[len(dirs):])
+        ]
+        conn.executemany(sql, rows)
+        conn.commit()
+    conn.close()
+
+
+@command()
+@option('-d', '--depth', default=4, help='Max directory depth under each root; default: 4')
+@option('-f', '--fanout', default=10, help='Subdirectories per directory; default: 10')
+@option('-n', '--num-rows', default=50e6, type=float, help='Number of (file) rows to populate the DB with; default: 50e6')
+@option('-p', '--db-path', help='SQLite DB to populate (if empty) and query; default: a temporary file')
+@option('-q', '--num-queries', default=10, help='Number of subtrees (of each kind) to fetch; default: 10')
+@option('-r', '--num-roots', default=1000, help='Number of roots to spread the rows across; default: 1000')
+@option('-s', '--seed', default=0, help='Random seed; default: 0')
+def main(depth, fanout, num_rows, db_path, num_queries, num_roots, seed):
+    with TemporaryDirectory() as tmpdir:
+        db_path = db_path or join(tmpdir, 'disk-tree.db')
+        from disk_tree.db import init, migrate
+        db = init(db_path)
+        from disk_tree.model import Node, resolve, subtree, subtree_ids
+        db.create_all()
+        migrate()
+        if not db.session.query(Node.id).first():
+            start = perf_counter()
+            populate(db_path, int(num_rows), num_roots, depth, fanout, seed)
+            print(f'Populated {db_path} with {int(num_rows)} rows across {num_roots} roots in {perf_counter() - start:.1f}s')
+
+        random.seed(seed)
+        roots = [ f'/bench/r{r}' for r in random.sample(range(num_roots), min(num_queries, num_roots)) ]
+        subdirs = [ f'{root}/d{random.randrange(fanout)}' for root in roots ]
+
+        def fetch(path, how):
+            row = resolve([ path ])[path]
+            if how == 'interval':
+                query = db.session.query(Node.id, Node.name, Node.size).filter(Node.lo.between(row.lo, row.hi))
+            elif how == 'CTE (ids)':
+                query = db.session.query(Node.id, Node.name, Node.size).filter(Node.id.in_(subtree_ids([ row.id ])))
+            else:
+                sub = subtree(row.id, path)
+                query = db.session.query(sub.c.id, sub.c.path, sub.c.size)
+            return query.all()
+
+        for kind, paths in [ ('roots', roots), ('subdirs', subdirs) ]:
+            for how in [ 'interval', 'CTE (ids)', 'CTE (paths)' ]:
+                elapsed = []
+                num_fetched = 0
+                for path in paths:
+                    start = perf_counter()
+                    num_fetched += len(fetch(path, how))
+                    elapsed.append(perf_counter() - start)
+                print(f'{kind}, {how}: {num_fetched / len(paths):.0f} rows/subtree, median {np.median(elapsed) * 1000:.1f}ms, max {max(elapsed) * 1000:.1f}ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+from sqlalchemy import func
+from sqlalchemy.dialects.sqlite import insert
+
+from .db import db
+from .stats import timer
+
+DEFAULT_BATCH_SIZE = 10_000
+
+
+class BulkWriter:
+    """Buffer rows, and write them as batched ``INSERT … ON CONFLICT DO UPDATE`` upserts, one transaction per flush."""
+    def __init__(self, batch_size=None, stats=None):
+        self.batch_size = batch_size or DEFAULT_BATCH_SIZE
+        self.stats = stats
+        self.rows = {}
+        self.num_rows = 0
+
+    def extend(self, table, rows):
+        self.rows.setdefault(table, []).extend(rows)
+        self.num_rows += len(rows)
+        if self.num_rows >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.num_rows:
+            return
+        with timer(self.stats, 'db_write_time'):
+            for table, rows in self.rows.items():
+                stmt = insert(table)
+                # Rows conflict on the table's `upsert_key` (a unique index), if it has one, else its primary key
+                key = table.info.get('upsert_key') or [ c.name for c in table.primary_key ]
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=list(key),
+                    set_={
+                        # `preserve`d columns keep their existing values, unless set
+                        c.name: func.coalesce(stmt.excluded[c.name], c) if c.info.get('preserve') else stmt.excluded[c.name]
+                        for c in table.columns
+                        if not c.primary_key and c.name not in key
+                    },
+                )
+                db.session.execute(stmt, rows)
+            db.session.commit()
+        if self.stats is not None:
+            self.stats.record_rows(self.num_rows)
+        self.rows = {}
+        self.num_rows = 0
@@ -1,103 +1,405 @@
-from os import walk
 from os.path import abspath, dirname, exists, isdir, isfile, islink, join, basename
 
+import asyncio
 import os
 import pandas as pd
-import shlex
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from functools import partial
+from time import time_ns
 from datetime import datetime as dt
-from pandas import to_datetime as to_dt
-from subprocess import check_call, CalledProcessError
+from sqlalchemy import bindparam, func, text
+from sqlalchemy.orm import aliased
 from utz import err
 
-from . import s3
+from . import events, listing_cache, s3
+from .bulk import BulkWriter
 from .config import ROOT_DIR
-from .db import db, cache_url
-from .model import File, S3
+from .db import bulk_writes, db, cache_url
+from .inventory import Manifest
+from .model import CHILDREN, IN_BATCH_SIZE, ROOT, S3_SCHEME, Checkpoint, Node, is_placeholder, resolve, s3_key, s3_path, s3_root, split, subtree, subtree_ids
+from .s3_list import ShardedListing
+from .scan import DEFAULT_CHECKPOINT_INTERVAL, Scanner, is_descendant
+from .scan_async import AsyncScanner, in_thread
+from .stats import timer
+from .tree import Tree
 
+# mtimes migrated from earlier versions' `DateTime`s were truncated to µs (from float `st_mtime`s)
+US = 1000
+NODES = Node.__table__
+# Buffered rows' defaults (`None`s, for columns a row doesn't set); every row in a batch sets every column
+ROW = { c.name: None for c in NODES.columns }
+# Rows inserted, updated or deleted on the connection so far (see `Cache.expire`)
+TOTAL_CHANGES = text('SELECT total_changes()')
 
-def is_descendant(path, ancestor):
-    path = path.rstrip('/').split('/')
-    ancestor = ancestor.rstrip('/').split('/')
-    if len(path) < len(ancestor):
-        return False
-    for (l, r) in zip(path, ancestor):
-        if l != r:
-            return False
-    return True
 
+class UnsortedListing(ValueError):
+    """A listing passed to ``Cache.refresh_s3`` isn't sorted by key."""
 
-def strip_prefix(key, prefix):
-    if not prefix:
-        return key
-    if key.startswith(prefix):
-        return key[len(prefix):]
-    else:
-        raise ValueError(f"Key {key} doesn't start with expected prefix {prefix}")
+
+def is_unchanged_file(stat, cached):
+    return (
+        cached.kind == 'file' and
+        cached.size == stat.st_size and
+        abs(cached.mtime - stat.st_mtime_ns) <= US
+    )
+
+
+def is_unchanged_row(row, cached):
+    return (
+        row['size'] == cached.size and
+        row['num_descendants'] == cached.num_descendants and
+        abs(row['mtime'] - cached.mtime) <= US and
+        row['st_mtime_ns'] == cached.st_mtime_ns and
+        row['st_ctime_ns'] == cached.st_ctime_ns
+    )
 
 
 class Cache:
-    def __init__(self, ttl=None):
+    def __init__(
+            self,
+            ttl=None,
+            jobs=None,
+            batch_size=None,
+            incremental=False,
+            aio=False,
+            concurrency=None,
+            mount_concurrency=None,
+            one_file_system=False,
+            checkpoint_interval=DEFAULT_CHECKPOINT_INTERVAL,
+            stats=None,
+    ):
         err(f'Using cache: {cache_url}')
         self.ttl = ttl
+        self.jobs = jobs
+        self.stats = stats
+        self.incremental = incremental
+        self.aio = aio
+        self.concurrency = concurrency
+        self.mount_concurrency = mount_concurrency
+        self.one_file_system = one_file_system
+        self.checkpoint_interval = checkpoint_interval
+        self.skipped_mounts = []
+        self.scanned = {}
+        # Node ids, by path (see `model.resolve`)
+        self.ids = {}
+        self.writer = BulkWriter(batch_size, stats=stats)
+
+    def is_fresh(self, checked_at, now):
+        """Whether ``checked_at`` is within the TTL of ``now`` (both in ns since the epoch)."""
+        return now - checked_at <= self.ttl.value
 
     def compute_s3(self, url, bucket, root_key):
-        now = to_dt(dt.now())
-        e = S3.query.get((bucket, root_key))
-        if e:
-            elem_age = now - e.checked_at
-            if elem_age <= self.ttl:
+        now = time_ns()
+        e = self.node(s3_path(bucket, root_key))
+        if e and self.is_fresh(e.checked_at, now):
+            return e
+
+        ancestor = self.fresh_s3_ancestor(bucket, root_key, now)
+        if ancestor is not None:
+            if e:
+                # Refreshed (with all its descendants) as part of `ancestor`
                 return e
+            # Listed (with all its descendants) within the TTL, and `root_key` wasn't among them
+            raise ValueError(f'{url} not found in {ancestor.path} (listed at {dt.fromtimestamp(ancestor.checked_at / 1e9)})')
+
+        prefix = f'{root_key}/' if root_key else None
+        listing = None
+        # The nearest listing cache (for `root_key` or an ancestor) that's within the TTL, if any
+        keys = [ root_key ] + s3.dirs(root_key)[::-1] if root_key else [ '' ]
+        for key in keys:
+            s3_cache_path = self.s3_listing_cache_path(bucket, key)
+            if exists(s3_cache_path):
+                mtime = os.stat(s3_cache_path).st_mtime_ns
+                if self.is_fresh(mtime, now):
+                    err(f'Found {s3_cache_path} ({pd.Timedelta(now - mtime)} old)')
+                    listing = listing_cache.read(s3_cache_path)
+                    if key != root_key:
+                        listing = s3.filter_prefix(listing, prefix)
+                    break
+        if listing is None:
+            s3_cache_path = self.s3_listing_cache_path(bucket, root_key)
+            listing = self.list_s3(bucket, prefix, s3_cache_path)
+            if e and e.kind == 'dir':
+                # Shards are listed concurrently, so their blocks interleave; diff against the complete (sorted) listing
+                for _ in listing:
+                    pass
+                listing = listing_cache.read(s3_cache_path)
+
+        with bulk_writes():
+            if e and e.kind == 'dir':
+                return self.refresh_s3(bucket, e, listing, now)
+            return self.ingest_s3(bucket, root_key, listing, now)
+
+    def compute_s3_inventory(self, url, bucket, root_key, manifest_path):
+        """Populate the cache for ``url`` from a local copy of an S3 Inventory report (instead of listing the bucket)."""
+        manifest = Manifest(manifest_path)
+        if manifest.bucket != bucket:
+            raise ValueError(f'{manifest_path} is an inventory of s3://{manifest.bucket}, not s3://{bucket}')
+        err(f'Reading S3 Inventory {manifest_path} ({len(manifest.files)} {manifest.file_format} files, created {manifest.created})')
+
+        def listing():
+            blocks = manifest.blocks()
+            return s3.filter_prefix(blocks, f'{root_key}/') if root_key else blocks
 
-        S3_LINE_CACHE = join(ROOT_DIR, '.s3/ls')
-        s3_cache_path = join(*(
-                [S3_LINE_CACHE, bucket] +
+        e = self.node(s3_path(bucket, root_key))
+        with bulk_writes():
+            # Rows are as fresh as the inventory
+            if e and e.kind == 'dir':
+                # Diff the inventory against the cached rows, so that objects deleted since those were written are
+                # removed. That needs it sorted by key, which S3 Inventory doesn't guarantee across (or within) data
+                # files; if it isn't (detected before anything is written), the cached subtree is replaced instead.
+                try:
+                    return self.refresh_s3(bucket, e, listing(), manifest.created_ns)
+                except UnsortedListing:
+                    err(f"{manifest_path}'s data files aren't sorted by key; re-ingesting {url}")
+                    self.expire(e, exist_ok=True, commit=False)
+            return self.ingest_s3(bucket, root_key, listing(), manifest.created_ns)
+
+    def compute_s3_events(self, url, bucket, root_key, paths):
+        """Apply S3 event notifications (from ``paths``) to the cached rows of ``bucket``, and return ``url``'s row."""
+        now = time_ns()
+        applied, outside, ignored = 0, 0, 0
+        with bulk_writes():
+            for batch in events.events(paths, bucket):
+                num_applied, num_outside = self.apply_s3_events(bucket, batch, now)
+                applied += num_applied
+                outside += num_outside
+                ignored += len(batch) - num_applied - num_outside
+        skipped = [
+            f'{outside} outside cached prefixes' if outside else None,
+            f'{ignored} with no effect on cached rows (e.g. removals of objects that weren\'t cached)' if ignored else None,
+        ]
+        skipped = [ s for s in skipped if s ]
+        err(f'Applied {applied} S3 events to s3://{bucket}' + (f'; skipped {", ".join(skipped)}' if skipped else ''))
+        root = self.node(s3_path(bucket, root_key))
+        if root is None:
+            raise ValueError(f'{url} is not cached')
+        return root
+
+    def apply_s3_events(self, bucket, batch, now):
+        """Apply a batch of ``{key: (events.CREATED|REMOVED, size, mtime)}`` object events to cached rows: upsert created
+        files and delete removed ones, and add the resulting size / count changes (and max mtime) to each one's ancestor
+        directories (O(depth) per event). Directories are created as needed, and deleted once empty; those whose latest
+        mtime was removed (or moved back) have their mtime recomputed from their remaining children.
+
+        Only objects under a cached directory are updated (ancestors above the topmost cached one are left alone);
+        returns the number of events applied, and of those skipped for being outside any cached directory."""
+        ancestors = { key: events.ancestors(key) for key in batch }
+        rows = self.s3_rows(bucket, set(batch) | { a for ancs in ancestors.values() for a in ancs })
+        deltas = {}
+        files = []
+        deletes = []
+        stale = set()
+        applied, outside = 0, 0
+        for key, (kind, size, mtime) in batch.items():
+            ancs = ancestors[key]
+            cached = [ i for i, a in enumerate(ancs) if a in rows ]
+            if not cached or any(rows[ancs[i]].kind != 'dir' for i in cached):
+                outside += 1
+                continue
+            old = rows.get(key)
+            if old is not None and old.kind != 'file':
+                continue
+            if kind == events.CREATED:
+                size_delta, num_delta = size - (old.size if old else 0), 0 if old else 1
+                files.append(dict(key=key, mtime=mtime, size=size, kind='file', num_descendants=1, checked_at=now))
+            elif old is not None:
+                size_delta, num_delta, mtime = -old.size, -1, None
+                deletes.append(key)
+            else:
+                continue
+            ancs = ancs[:cached[-1] + 1]
+            if old is not None and (mtime is None or mtime < old.mtime):
+                stale.update(a for a in ancs if a in rows and old.mtime >= rows[a].mtime)
+            for a in ancs:
+                delta = deltas.setdefault(a, [ 0, 0, None ])
+                delta[0] += size_delta
+                delta[1] += num_delta
+                if mtime is not None and (delta[2] is None or mtime > delta[2]):
+                    delta[2] = mtime
+            applied += 1
+        dirs = []
+        for a, (size_delta, num_delta, mtime) in deltas.items():
+            row = rows.get(a)
+            if row is None:
+                size, num_descendants, checked_at = size_delta, num_delta, now
+            else:
+                size, num_descendants, checked_at = row.size + size_delta, row.num_descendants + num_delta, row.checked_at
+                mtime = row.mtime if mtime is None else max(row.mtime, mtime)
+            if num_descendants <= 0 and a:
+                deletes.append(a)
+            else:
+                dirs.append(dict(key=a, mtime=mtime, size=size, kind='dir', num_descendants=num_descendants, checked_at=checked_at))
+        if files or dirs:
+            self.insert_s3(bucket, pd.DataFrame(files + dirs), now)
+        self.flush()
+        for i in range(0, len(deletes), IN_BATCH_SIZE):
+            ids = [ rows[key].id for key in deletes[i:i + IN_BATCH_SIZE] ]
+            Node.query.filter(Node.id.in_(ids)).delete(synchronize_session=False)
+        for key in deletes:
+            self.ids.pop(s3_path(bucket, key), None)
+        # Deepest first, so that each directory's children are up to date
+        for a in sorted(stale.difference(deletes), key=lambda a: -len(events.ancestors(a))):
+            child = aliased(Node)
+            mtime = db.session.query(func.max(child.mtime)).filter(child.parent_id == rows[a].id).scalar_subquery()
+            Node.query.filter(Node.id == rows[a].id).update({ Node.mtime: mtime }, synchronize_session=False)
+        db.session.commit()
+        return applied, outside
+
+    def refresh_s3(self, bucket, root, listing, now):
+        """Update ``root``'s (expired) cached subtree to match ``listing`` (blocks of files, sorted by key).
+
+        The listing is sort-merged against the cached files (streamed in key order), and only new, changed and vanished
+        objects are written (along with their ancestors' totals; see ``apply_s3_events``), so writes scale with the
+        churn since the last listing, rather than the size of the listing."""
+        prefix = f'{s3_key(root.path)}/' if s3_key(root.path) else ''
+        cached = self.s3_files(root)
+        pending = next(cached, None)
+        start_after = None
+        batch = {}
+        for files in listing:
+            files = files[~files.key.str.endswith('/')]
+            if files.empty:
+                continue
+            if not files.key.is_monotonic_increasing or (start_after is not None and files.key.iloc[0] <= start_after):
+                raise UnsortedListing(f'Listing of s3://{bucket}/{prefix} is not sorted by key')
+            end = files.key.iloc[-1]
+            block = []
+            while pending is not None and pending[0] <= end:
+                block.append(pending)
+                pending = next(cached, None)
+            batch.update(self.diff_s3(files, block))
+            start_after = end
+        # Cached files past the end of the listing
+        block = [] if pending is None else [ pending, *cached ]
+        batch.update(self.diff_s3(None, block))
+        # Changes are applied once the cached files have been read (and their cursor closed)
+        num_changed = 0
+        items = list(batch.items())
+        for i in range(0, len(items), events.BATCH_SIZE):
+            num_changed += self.apply_s3_events(bucket, dict(items[i:i + events.BATCH_SIZE]), now)[0]
+        Node.query.filter(Node.id == root.id).update({ Node.checked_at: now }, synchronize_session=False)
+        db.session.commit()
+        err(f'Refreshed s3://{bucket}/{prefix}: {num_changed} objects added, changed, or removed')
+        return self.node(root.path)
+
+    def s3_files(self, root):
+        """Yield ``(key, size, mtime)`` for the cached files under ``root``, sorted by key."""
+        n = len(s3_root(root.path[len(S3_SCHEME):].partition('/')[0]))
+        sub = subtree(root.id, root.path)
+        query = db.session.query(sub.c.path, sub.c.size, sub.c.mtime).filter(sub.c.kind == 'file').order_by(sub.c.path)
+        for path, size, mtime in query.yield_per(IN_BATCH_SIZE * 20):
+            yield path[n:], size, mtime
+
+    @staticmethod
+    def diff_s3(files, cached):
+        """``apply_s3_events``-style events for the differences between (listed) ``files`` and ``cached`` ``(key, size,
+        mtime)`` tuples (over the same key range)."""
+        cached = pd.DataFrame(cached, columns=[ 'key', 'size', 'mtime' ]).astype(dict(mtime='int64'))
+        if files is None:
+            files = cached[:0]
+        else:
+            files = files.assign(mtime=files['mtime'].astype('datetime64[ns]').astype('int64'))
+        merged = files[[ 'key', 'size', 'mtime' ]].merge(cached, on='key', how='outer', suffixes=('', '_cached'), indicator=True)
+        listed = merged['_merge'] != 'right_only'
+        changed = listed & (
+            (merged['_merge'] == 'left_only') |
+            (merged['size'] != merged['size_cached']) |
+            (merged['mtime'] != merged['mtime_cached'])
+        )
+        batch = {
+            key: (events.CREATED, int(size), int(mtime))
+            for key, size, mtime in zip(merged['key'][changed], merged['size'][changed], merged['mtime'][changed])
+        }
+        batch.update({ key: (events.REMOVED, 0, None) for key in merged['key'][~listed] })
+        return batch
+
+    def s3_rows(self, bucket, keys):
+        """Cached (non-placeholder) rows of ``bucket``'s ``keys``, by key."""
+        paths = { s3_path(bucket, key): key for key in keys }
+        with timer(self.stats, 'db_read_time'):
+            rows = resolve(paths, self.ids)
+        return { paths[path]: row for path, row in rows.items() if not is_placeholder(row) }
+
+    def ingest_s3(self, bucket, root_key, listing, now):
+        """Insert rows for the files in ``listing`` (blocks of ``mtime``, ``size`` and ``key`` columns) and the
+        directories containing them.
+
+        Each block's file rows are written as it arrives, and its directories' partial totals are folded into ``dirs``,
+        so memory is bounded by the block size and the number of directories."""
+        prefix = f'{root_key}/' if root_key else None
+        dirs = s3.DirTotals()
+        for files in listing:
+            files = files[~files.key.str.endswith('/')]
+            if files.empty:
+                continue
+            files['relpath'] = s3.strip_prefixes(files['key'], prefix)
+            files['root_key'] = root_key
+            aggd = s3.agg_dirs(files)
+            is_dir = aggd.kind == 'dir'
+            self.insert_s3(bucket, aggd[~is_dir], now)
+            dirs.add(aggd[is_dir])
+        dirs = dirs.total()
+        if dirs is not None:
+            self.insert_s3(bucket, dirs, now)
+        self.flush()
+        root = self.node(s3_path(bucket, root_key))
+        if root is None:
+            raise ValueError(f'No objects found under {s3_path(bucket, root_key)}')
+        return root
+
+    def fresh_s3_ancestor(self, bucket, root_key, now):
+        """Nearest directory above ``root_key`` whose cached row (and so, whose descendants' rows) is within the TTL."""
+        ancestors = s3.dirs(root_key) if root_key else []
+        rows = self.s3_rows(bucket, ancestors)
+        fresh = [ key for key, row in rows.items() if row.kind == 'dir' and self.is_fresh(row.checked_at, now) ]
+        return self.node(s3_path(bucket, max(fresh, key=len))) if fresh else None
+
+    @staticmethod
+    def s3_listing_cache_path(bucket, root_key):
+        """Path to the listing cache for ``s3://bucket/root_key``; a (legacy) ``aws s3 ls --recursive``-style ``.txt``
+        cache there is migrated first."""
+        base = join(*(
+                [ROOT_DIR, '.s3/ls', bucket] +
                 ([root_key] if root_key else [])
-        )) + '.txt'
-        cached = False
-        if exists(s3_cache_path):
-            stat = os.stat(s3_cache_path)
-            mtime = to_dt(stat.st_mtime, unit='s')
-            cache_age = now - mtime
-            if cache_age <= self.ttl:
-                err(f'Found {s3_cache_path} ({cache_age} old)')
-                cached = True
-
-        if not cached:
-            parent = dirname(s3_cache_path)
-            os.makedirs(parent, exist_ok=True)
-            try:
-                with open(s3_cache_path, 'w') as f:
-                    cmd = ['aws', 's3', 'ls', '--recursive', url]
-                    err(f'Running: {shlex.join(cmd)} > {s3_cache_path}')
-                    check_call(cmd, stdout=f)
-            except CalledProcessError as e:
-                os.remove(s3_cache_path)
-                raise
-
-        with open(s3_cache_path, 'r') as f:
-            lines = [ line.rstrip('\n') for line in f.readlines() ]
-
-        files = pd.DataFrame([ s3.parse_line(line) for line in lines ])
-        files = files[~files.key.str.endswith('/')]
-        files['relpath'] = files['key'].apply(strip_prefix, prefix=f'{root_key}/' if root_key else None)
-        files['root_key'] = root_key
-        aggd = s3.agg_dirs(files).sort_values('key')
-        # aggd['url'] = f's3://{bucket}/' + aggd['key']
-        aggd['bucket'] = bucket
-        # aggd['root_key'] = root_key
-        #aggd['key'] = aggd['root_key'] + '/' + aggd['relpath']
-        aggd['parent'] = aggd['key'].apply(dirname)
-        aggd['checked_at'] = now
-        keys = [ 'bucket', 'key', 'mtime', 'size', 'parent', 'kind', 'num_descendants', 'checked_at', ]
-        for idx, r in aggd.iterrows():
-            e = S3(**{
-                k: r[k]
-                for k in keys
-            })
-            self.insert(e)
-        #aggd = aggd.drop(columns=['root_key'])
-        #return aggd
-        return S3.query.get((bucket, root_key))
+        ))
+        path = f'{base}.lsz'
+        txt_path = f'{base}.txt'
+        if exists(txt_path) and not exists(path):
+            err(f'Migrating {txt_path} to {path}')
+            listing_cache.migrate(txt_path, path)
+        return path
+
+    def list_s3(self, bucket, prefix, s3_cache_path):
+        """List ``bucket`` natively, in concurrent key-range shards, yielding blocks of keys as they arrive (see
+        ``s3_list.ShardedListing``); an interrupted listing (started within the TTL) is resumed."""
+        os.makedirs(dirname(s3_cache_path), exist_ok=True)
+        listing = ShardedListing(s3_cache_path, bucket, prefix or '', jobs=self.jobs)
+        age = listing.age()
+        if age is not None and age > self.ttl:
+            err(f'Discarding interrupted listing of s3://{bucket}/{prefix or ""} ({age} old)')
+            listing.discard()
+        err(f'Listing s3://{bucket}/{prefix or ""} > {s3_cache_path}')
+        return listing.blocks()
+
+    def insert_s3(self, bucket, rows, now):
+        """Upsert ``bucket``'s ``rows`` (``key``, ``mtime``, ``size``, ``kind`` and ``num_descendants`` columns, and
+        ``checked_at``, default: ``now``), under their parents' nodes (inserted as placeholders, if missing)."""
+        if rows.empty:
+            return
+        if 'checked_at' not in rows:
+            rows = rows.assign(checked_at=now)
+        keys = rows['key'].tolist()
+        parts = [ key.rpartition('/') for key in keys ]
+        self.node_ids({ s3_path(bucket, parent) for (parent, _, _), key in zip(parts, keys) if key }, create=True)
+        root = s3_root(bucket)
+        rows = rows.assign(
+            parent_id=[ self.ids[s3_path(bucket, parent)] if key else ROOT for (parent, _, _), key in zip(parts, keys) ],
+            name=[ name if key else root for (_, _, name), key in zip(parts, keys) ],
+        )
+        cols = [ 'parent_id', 'name', 'mtime', 'size', 'kind', 'num_descendants', 'checked_at' ]
+        self.writer.extend(NODES, [ dict(ROW, **row) for row in rows[cols].to_dict('records') ])
 
     def compute_file(self, path, now=None, fsck=False, excludes=None):
         path = abspath(path)
@@ -107,132 +409,376 @@ class Cache:
         else:
             return self.compute(path, now=now, fsck=fsck, excludes=excludes)
 
+    async def compute_file_async(self, path, now=None, fsck=False, excludes=None):
+        path = abspath(path)
+        with ThreadPoolExecutor(1) as db_executor:
+            record = await in_thread(db_executor, self.get, path)
+            if record:
+                return record
+            else:
+                return await self.compute_async(path, now=now, fsck=fsck, excludes=excludes, db_executor=db_executor)
+
     def compute(self, path, now=None, fsck=False, excludes=None):
         if excludes and any(is_descendant(path, exclude) for exclude in excludes):
             err(f'skipping excluded: {path}')
             return None
+        if not now:
+            now = time_ns()
         if islink(path):
             err(f'Skipping symlink: {path}')
             return None
         elif isfile(path):
-            if not now:
-                now = to_dt(dt.now())
-            stat = os.stat(path)
-            mtime = to_dt(stat.st_mtime, unit='s')
-            size = stat.st_size
-            parent = dirname(path)
-            file = File(
-                path=path,
-                mtime=mtime,
-                size=size,
-                parent=parent,
-                kind='file',
-                num_descendants=1,
-                checked_at=now,
-            )
-            self.insert(file)
-            return file
+            self.insert_file(path, os.stat(path), now=now)
+            self.flush()
+            self.number_subtree(path)
+            return self.node(path)
         elif isdir(path):
-            try:
-                _, dirs, files = next(walk(path))
-            except StopIteration:
-                err(f'Error traversing {path}')
-                return None
-            files_map = { file: self.compute(join(path, file), excludes=excludes) for file in files }
-            dirs_map = { dir: self.compute(join(path, dir), excludes=excludes) for dir in dirs }
-            all_keys = set(files_map.keys()) | set(dirs_map.keys())
-            files = list(filter(None, files_map.values()))
-            dirs = list(filter(None, dirs_map.values()))
-            children = files + dirs
-            db_children = File.query.filter((File.parent == path) & File.path.not_in(excludes)).all()
-            expired_children = [ c for c in db_children if basename(c.path) not in all_keys ]
-            if expired_children:
-                err(f'Cache: expiring {len(expired_children)} stale children of {path}:')
-                for child in expired_children:
-                    err(f'\t{child.path}')
-                    self.expire(child)
-            num_descendants = sum( c.num_descendants for c in children )
-            size = sum( c.size for c in children )
-            parent = dirname(path)
+            if self.stats:
+                self.stats.start()
             stat = os.stat(path)
-            mtime = to_dt(stat.st_mtime, unit='s')
-            if children:
-                mtime = max(mtime, max(c.mtime for c in children))
-            if not now:
-                now = to_dt(dt.now())
-            d = File(
-                path=path,
-                mtime=mtime,
-                size=size,
-                parent=parent,
-                kind='dir',
-                num_descendants=num_descendants,
-                checked_at=now,
-            )
-            self.insert(d)
-            if fsck:
-                descendants = File.query.filter(File.path.startswith(path)).all()
-                for descendant in descendants:
-                    path = descendant.path
-                    if not exists(path):
-                        self.expire(descendant)
-            return d
+            cached = self.cached_row(path) if self.incremental else None
+            with bulk_writes():
+                if self.aio:
+                    with ThreadPoolExecutor(1) as db_executor:
+                        scanner = self.async_scanner(db_executor, now=now, excludes=excludes)
+                        d = asyncio.run(scanner.scan(path, stat, cached))
+                else:
+                    scanner = Scanner(
+                        self,
+                        jobs=self.jobs,
+                        now=now,
+                        excludes=excludes,
+                        one_file_system=self.one_file_system,
+                        checkpoint_interval=self.checkpoint_interval,
+                    )
+                    d = scanner.scan(path, stat, cached)
+                return self.finish_dir(path, d, scanner, now=now, fsck=fsck, excludes=excludes)
         else:
             raise RuntimeError(f'Unrecognized path type: {path}')
 
-    def expire(self, file, exist_ok=False, top_level=True, commit=True):
+    async def compute_async(self, path, now=None, fsck=False, excludes=None, db_executor=None):
+        """Like ``compute``, but scans directories with an ``AsyncScanner`` on the running event loop; DB access runs on
+        ``db_executor`` (default: a new single thread), off the loop."""
+        if db_executor is None:
+            with ThreadPoolExecutor(1) as db_executor:
+                return await self.compute_async(path, now=now, fsck=fsck, excludes=excludes, db_executor=db_executor)
+        db = partial(in_thread, db_executor)
+        if not isdir(path) or islink(path) or (excludes and any(is_descendant(path, exclude) for exclude in excludes)):
+            return await db(self.compute, path, now=now, fsck=fsck, excludes=excludes)
+        if not now:
+            now = time_ns()
+        if self.stats:
+            self.stats.start()
+        stat = os.stat(path)
+        cached = await db(self.cached_row, path) if self.incremental else None
+        scanner = self.async_scanner(db_executor, now=now, excludes=excludes)
+        bulk = ExitStack()
+        await db(bulk.enter_context, bulk_writes())
+        try:
+            d = await scanner.scan(path, stat, cached)
+            return await db(self.finish_dir, path, d, scanner, now=now, fsck=fsck, excludes=excludes)
+        finally:
+            await db(bulk.close)
+
+    def async_scanner(self, db_executor, now, excludes=None):
+        return AsyncScanner(
+            self,
+            db_executor,
+            concurrency=self.concurrency,
+            mount_concurrency=self.mount_concurrency,
+            now=now,
+            excludes=excludes,
+            one_file_system=self.one_file_system,
+            checkpoint_interval=self.checkpoint_interval,
+        )
+
+    def finish_dir(self, path, d, scanner, now, fsck=False, excludes=None):
+        self.flush()
+        if d is not None:
+            # The scan's root row is the only one built as a `Node` (for the caller); the rest are written as dicts
+            d = Node(**d)
+            d.path = path
+            d.lo, d.hi = self.number_subtree(path)
+        self.clear_checkpoint(path)
+        if d is not None and not scanner.fresh:
+            # The scan's tree omits the subtrees of reused fresh subdirectories
+            self.scanned[path] = scanner.tree
+        if scanner.skipped_mounts:
+            err(f'Skipped {len(scanner.skipped_mounts)} mountpoints under {path}')
+            self.skipped_mounts += scanner.skipped_mounts
+        if d and self.incremental:
+            self.touch(path, now=now, excludes=excludes)
+        if self.stats:
+            self.stats.stop()
+        if d and fsck:
+            self.fsck_dir(d)
+        return d
+
+    def checkpoint_frontier(self, root):
+        with timer(self.stats, 'db_read_time'):
+            return [ c.path for c in Checkpoint.query.filter(Checkpoint.root == root).all() ]
+
+    def checkpoint(self, root, incomplete, now):
+        """Persist rows completed so far, and the ``incomplete`` directories of a scan of ``root``, so it can resume."""
+        self.flush()
+        with timer(self.stats, 'db_write_time'):
+            Checkpoint.query.filter(Checkpoint.root == root).delete(synchronize_session=False)
+            rows = [ dict(root=root, path=path, checked_at=now) for path in incomplete ]
+            if rows:
+                db.session.execute(Checkpoint.__table__.insert(), rows)
+            db.session.commit()
+
+    def clear_checkpoint(self, root):
+        Checkpoint.query.filter(Checkpoint.root == root).delete(synchronize_session=False)
+        db.session.commit()
+
+    def fresh_subdirs(self, path):
+        """Topmost directories strictly under ``path`` whose cached rows are fresh (from an interrupted scan of ``path``,
+        or scans of the subdirectories themselves), keyed by path."""
+        if self.ttl is None:
+            return {}
+        with timer(self.stats, 'db_read_time'):
+            root = resolve([ path ], self.ids).get(path)
+            if root is None:
+                return {}
+            since = time_ns() - self.ttl.value
+            sub = subtree(
+                root.id, path,
+                filter=lambda child: child.kind == 'dir',
+                descend=lambda sub: sub.c.checked_at < since,
+            )
+            rows = db.session.query(sub).filter((sub.c.id != root.id) & (sub.c.checked_at >= since)).all()
+        return { row.path: row for row in rows }
+
+    def tree(self, root, excludes=None):
+        """``Tree`` of ``root`` (a ``Node``, with its ``path``) and its descendants: from this session's scan of
+        ``root``, if there was one, otherwise loaded from the cache."""
+        tree = self.scanned.get(root.path)
+        if tree is None:
+            node = self.node(root.path)
+            # S3 trees' roots are named by their keys
+            name = s3_key(root.path) if root.path.startswith(S3_SCHEME) else root.path
+            with timer(self.stats, 'db_read_time'):
+                tree = Tree.from_rows(node.tree_rows(excludes), root_name=name)
+        return tree
+
+    def node(self, path):
+        """The cached (non-placeholder) ``Node`` at ``path`` (with its ``path`` set), if any."""
+        with timer(self.stats, 'db_read_time'):
+            row = resolve([ path ], self.ids).get(path)
+            if row is None or is_placeholder(row):
+                return None
+            node = Node.query.get(row.id)
+        node.path = path
+        return node
+
+    def node_ids(self, paths, create=False):
+        """Resolve (memoized) ids of the nodes at ``paths``, into ``self.ids``; with ``create``, missing ones are
+        inserted as placeholders."""
+        paths = [ path for path in paths if path not in self.ids ]
+        if paths:
+            with timer(self.stats, 'db_read_time'):
+                resolve(paths, self.ids, create=create)
+
+    def node_id(self, path, create=False):
+        if path not in self.ids:
+            self.node_ids([ path ], create=create)
+        return self.ids.get(path)
+
+    def cached_row(self, path):
+        with timer(self.stats, 'db_read_time'):
+            return resolve([ path ], self.ids).get(path)
+
+    def db_children(self, path, excludes=None):
+        id = self.node_id(path)
+        if id is None:
+            return []
+        prefix = path if split(path)[0] is None else f'{path}/'
+        with timer(self.stats, 'db_read_time'):
+            children = db.session.execute(CHILDREN, dict(id=id, prefix=prefix, excludes=excludes or [])).all()
+        self.ids.update((child.path, child.id) for child in children if child.kind == 'dir')
+        return children
+
+    def insert_file(self, path, stat, now=None, cached=None):
+        """Buffer a row for file ``path`` (unless ``cached`` matches ``stat``); returns its mtime (ns since the epoch), as
+        cached."""
+        if cached is not None and is_unchanged_file(stat, cached):
+            return cached.mtime
+        if not now:
+            now = time_ns()
+        parent, name = split(path)
+        self.insert(dict(
+            ROW,
+            parent_id=self.node_id(parent, create=True),
+            name=name,
+            mtime=stat.st_mtime_ns,
+            size=stat.st_size,
+            kind='file',
+            num_descendants=1,
+            checked_at=now,
+        ))
+        return stat.st_mtime_ns
+
+    def expire_stale(self, path, names, excludes=None, db_children=None):
+        """Expire cached children of directory ``path`` that aren't in its listing, ``names``."""
+        if db_children is None:
+            db_children = self.db_children(path, excludes)
+        expired_children = [ c for c in db_children if basename(c.path) not in names ]
+        if expired_children:
+            err(f'Cache: expiring {len(expired_children)} stale children of {path}:')
+            for child in expired_children:
+                err(f'\t{child.path}')
+                self.expire_id(child.id, child.path)
+
+    def expire_cached(self, path):
+        """Expire ``path``'s cached row and descendants, if any (e.g. a mountpoint that an earlier scan descended into,
+        before ``-X`` skipped it)."""
+        row = self.cached_row(path)
+        if row is None:
+            return
+        self.expire_id(row.id, path, exist_ok=True)
+
+    def expire_id(self, id, path, exist_ok=False):
+        """Expire row ``id`` (at ``path``) and its descendants, whether or not it's a placeholder (e.g. an ancestor of an
+        earlier scan's root)."""
+        node = Node.query.get(id)
+        node.path = path
+        return self.expire(node, exist_ok=exist_ok)
+
+    def insert_dir(self, path, stat, size, mtime, num_descendants, now=None, cached=None):
+        """Buffer a row for directory ``path``, with totals aggregated from its children (``mtime`` in ns since the
+        epoch), and return it (as a dict of ``Node`` columns)."""
+        parent, name = split(path)
+        if not now:
+            now = time_ns()
+        d = dict(
+            ROW,
+            parent_id=ROOT if parent is None else self.node_id(parent, create=True),
+            name=name,
+            mtime=mtime,
+            size=size,
+            kind='dir',
+            num_descendants=num_descendants,
+            checked_at=now,
+            st_mtime_ns=stat.st_mtime_ns,
+            st_ctime_ns=stat.st_ctime_ns,
+        )
+        self.insert(d, cached=cached)
+        return d
+
+    def touch(self, path, now, excludes=None):
+        """Mark ``path``'s cached subtree as checked at ``now`` (incremental scans skip writing unchanged rows)."""
+        Node.query.filter(self.node(path).subtree_filter(excludes)).update({ Node.checked_at: now }, synchronize_session=False)
+        db.session.commit()
+
+    def fsck_dir(self, d):
+        node = self.node(d.path)
+        sub = subtree(node.id, node.path)
+        descendants = db.session.query(sub.c.id, sub.c.path).order_by(sub.c.path).all()
+        expired = []
+        for id, path in descendants:
+            if any(is_descendant(path, e) for e in expired):
+                # Already expired, with a missing ancestor
+                continue
+            if not exists(path):
+                self.expire_id(id, path)
+                expired.append(path)
+
+    def expire(self, file, exist_ok=False, commit=True):
+        """Delete ``file``'s cached row and its descendants' (one range delete, by ``lo``, if it's ``ranged``)."""
         path = file.path
         if not exist_ok and exists(path):
             raise RuntimeError(f"Refusing to expire extant path {path}")
-        db_children = File.query.filter(File.parent == path).all()
-        if top_level:
-            err(f'Expiring {path}…')
-        num_expired = 0
-        for child in db_children:
-            num_expired += self.expire(child, exist_ok=exist_ok, top_level=False, commit=False)
-        db.session.delete(file)
-        if top_level:
-            err(f'Expired {path} and {num_expired} descendants')
+        err(f'Expiring {path}…')
+        # Counted via `total_changes()`: `rowcount` is -1 for `WITH …` statements (deletes of `subtree_ids`)
+        changes = db.session.execute(TOTAL_CHANGES).scalar()
+        Node.query.filter(file.subtree_filter()).delete(synchronize_session=False)
+        num_expired = db.session.execute(TOTAL_CHANGES).scalar() - changes - 1
+        # Memoized ids may belong to expired nodes
+        self.ids.clear()
+        err(f'Expired {path} and {num_expired} descendants')
         if commit:
             db.session.commit()
         return num_expired
 
-    def insert(self, file, commit=True):
-        existing = File.query.get(file.path)
-        if existing:
-            for k in ['mtime', 'size', 'parent', 'kind', 'num_descendants', 'checked_at']:
-                setattr(existing, k, getattr(file, k))
-        else:
-            db.session.add(file)
-        if commit:
-            db.session.commit()
+    def number_subtree(self, path):
+        """Assign nested intervals (``Node.lo``/``hi``) to ``path``'s (just written) subtree, returning its own.
+
+        Rows are ranked in pre-order, and packed into the interval of ``path`` or, if its subtree outgrew that, of the
+        nearest ancestor that still has room for its subtree (intervals may have spare room at the end); topmost rows
+        (under an unnumbered placeholder, or a root) get a fresh interval, past all others, with room to double. Only
+        rows whose interval changed are written."""
+        cols = [ Node.id, Node.parent_id, Node.lo, Node.hi ]
+        with timer(self.stats, 'db_read_time'):
+            node = resolve([ path ], self.ids)[path]
+            target = node.id
+            while True:
+                rows = db.session.query(*cols).filter(Node.id.in_(subtree_ids([ node.id ]))).all()
+                if node.lo is not None and node.hi - node.lo + 1 >= len(rows):
+                    lo, hi = node.lo, node.hi
+                    break
+                parent = db.session.query(*Node.__table__.columns).filter(Node.id == node.parent_id).one_or_none()
+                if parent is None or (parent.lo is None and is_placeholder(parent)):
+                    lo = (db.session.query(func.max(Node.hi)).scalar() or -1) + 1
+                    hi = lo + 2 * len(rows) - 1
+                    break
+                node = parent
+        children = {}
+        for row in rows:
+            children.setdefault(row.parent_id, []).append(row.id)
+        order = []
+        stack = [ node.id ]
+        while stack:
+            id = stack.pop()
+            order.append(id)
+            stack.extend(children.get(id, ()))
+        sizes = {}
+        for id in reversed(order):
+            sizes[id] = 1 + sum(sizes[child] for child in children.get(id, ()))
+        intervals = { row.id: (row.lo, row.hi) for row in rows }
+        updates = []
+        interval = None
+        for rank, id in enumerate(order):
+            new_lo, new_hi = lo + rank, (hi if rank == 0 else lo + rank + sizes[id] - 1)
+            if id == target:
+                interval = new_lo, new_hi
+            if intervals[id] != (new_lo, new_hi):
+                updates.append(dict(_id=id, lo=new_lo, hi=new_hi))
+        if updates:
+            with timer(self.stats, 'db_write_time'):
+                table = Node.__table__
+                db.session.execute(
+                    table.update().where(table.c.id == bindparam('_id')).values(lo=bindparam('lo'), hi=bindparam('hi')),
+                    updates,
+                )
+                db.session.commit()
+        return interval
+
+    def insert(self, row, cached=None):
+        """Buffer ``row`` (a dict of ``Node`` columns), unless it matches its ``cached`` row."""
+        if cached is not None and is_unchanged_row(row, cached):
+            return
+        self.writer.extend(NODES, [ row ])
+
+    def flush(self):
+        self.writer.flush()
 
     def get(self, path):
-        existing = File.query.get(path)
-        if existing:
-            now = dt.now()
-            if now - existing.checked_at <= self.ttl:
-                return existing
+        existing = self.node(path)
+        if existing and self.is_fresh(existing.checked_at, time_ns()):
+            return existing
         return None
 
     def missing_parents(self):
-        files = pd.read_sql_table('file', con=cache_url)
-        merged = (
-            files
-            [['path', 'parent', 'num_descendants']]
-            .merge(
-                files.path.rename('parent2'),
-                left_on='parent',
-                right_on='parent2',
-                how='left',
-            )
-        )
-        missing_parents = merged[merged.parent2.isna()]['path']
-        return missing_parents
+        """Nodes whose parent is missing (``id``, ``parent_id`` and ``name``)."""
+        rows = db.session.query(Node.id, Node.parent_id, Node.name).filter(
+            (Node.parent_id != ROOT) & Node.parent_id.not_in(db.session.query(Node.id))
+        ).all()
+        return pd.DataFrame(rows, columns=[ 'id', 'parent_id', 'name' ])
 
     def fsck(self):
-        files = pd.read_sql_table('file', con=cache_url)
-        gone_paths = ~(files['path'].apply(exists))
-        gone_parents = ~(files['parent'].apply(exists))
-        invalid = files[gone_paths | gone_parents]
-        err(f'Found {gone_paths.sum()} nonexistent paths and {gone_parents.sum()} nonexistent parents ({len(invalid)} total)')
+        root = resolve([ '/' ], self.ids).get('/')
+        sub = subtree(root.id, '/') if root else None
+        paths = pd.Series([ path for path, in db.session.query(sub.c.path) ] if sub is not None else [], dtype=object)
+        gone = ~(paths.apply(exists))
+        err(f'Found {gone.sum()} nonexistent paths (of {len(paths)} cached)')
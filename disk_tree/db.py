@@ -1,24 +1,130 @@
+from contextlib import contextmanager
+from functools import partial
 from os.path import abspath
 
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, inspect, text
+from sqlalchemy.pool import NullPool, QueuePool
 
 from .config import SQLITE_PATH
 
+# Seconds a connection waits on another's lock (e.g. a reader's, while the writer checkpoints the WAL) before failing
+BUSY_TIMEOUT = 60
+
+# Storage profiles: SQLite settings for the cache's connections (PRAGMAs are applied to each new connection; see
+# `connect`)
+PROFILES = {
+    # One writer (a scan) and any number of readers (renders) at once, without blocking each other: WAL journaling,
+    # relaxed to `synchronous=NORMAL` during bulk writes (see `bulk_writes`; commits aren't fsync'd, only WAL
+    # checkpoints are, so a power loss can lose the latest commits, but not corrupt the DB), 16KiB pages (new DBs
+    # only), a 64MiB page cache per connection, up to 1GiB of the DB memory-mapped, and connections (with their page
+    # caches) reused across transactions.
+    'wal': dict(
+        poolclass=QueuePool,
+        page_size=16 * 1024,
+        journal_mode='wal',
+        journal_size_limit=64 << 20,
+        synchronous='full',
+        bulk_synchronous='normal',
+        cache_size=-64 * 1024,
+        mmap_size=1 << 30,
+    ),
+    # SQLite's defaults, as used by earlier versions: rollback journal (a writer's commits wait for, and block, all
+    # readers), `synchronous=FULL`, and a new connection per transaction
+    'legacy': dict(
+        poolclass=NullPool,
+        journal_mode='delete',
+        synchronous='full',
+        bulk_synchronous='full',
+    ),
+}
+DEFAULT_PROFILE = 'wal'
+
 app = None
 db = None
 cache_url = None
+profile = None
+# Depth of nested `bulk_writes` blocks
+bulk_depth = 0
 
 
-def init(sqlite_path=None):
+def init(sqlite_path=None, read_only=False, profile_name=DEFAULT_PROFILE):
+    """Open the cache DB (with storage profile ``profile_name``); ``read_only`` connections (for rendering what's
+    cached, e.g. while another process scans) can't write, or create the DB."""
     global app
     global cache_url
     global db
+    global profile
     app = Flask(__name__)
     cache_path = abspath(sqlite_path or SQLITE_PATH)
     cache_url = f'sqlite:///{cache_path}'
-    app.config['SQLALCHEMY_DATABASE_URI'] = cache_url
+    profile = PROFILES[profile_name]
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///file:{cache_path}?mode=ro&uri=true' if read_only else cache_url
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = dict(
+        poolclass=profile['poolclass'],
+        # Pooled connections are used by one thread at a time, but not always the one that opened them
+        connect_args=dict(check_same_thread=False, timeout=BUSY_TIMEOUT),
+    )
     db = SQLAlchemy(app)
     app.app_context().push()
+    event.listen(db.engine, 'connect', partial(connect, read_only=read_only))
+    event.listen(db.engine, 'checkout', checkout)
     return db
+
+
+def connect(conn, record, read_only=False):
+    """Apply the storage profile's PRAGMAs to a new connection (``page_size`` before ``journal_mode``, as it only takes
+    effect on a new DB, and can't change once it's in WAL mode)."""
+    names = [ 'cache_size', 'mmap_size' ] if read_only else [ 'page_size', 'journal_mode', 'journal_size_limit', 'cache_size', 'mmap_size' ]
+    pragmas = { name: profile[name] for name in names if name in profile }
+    if read_only:
+        pragmas['query_only'] = 1
+    for name, value in pragmas.items():
+        conn.execute(f'PRAGMA {name} = {value}')
+
+
+def checkout(conn, record, proxy):
+    set_synchronous(conn, record.info)
+
+
+def set_synchronous(conn, info):
+    """Set ``conn``'s ``synchronous`` level to the profile's (bulk, within ``bulk_writes``) one, if it isn't already."""
+    synchronous = profile['bulk_synchronous' if bulk_depth else 'synchronous']
+    if info.get('synchronous') != synchronous:
+        conn.execute(f'PRAGMA synchronous = {synchronous}')
+        info['synchronous'] = synchronous
+
+
+@contextmanager
+def bulk_writes():
+    """Relax durability (to the profile's ``bulk_synchronous``) for a bulk scan or ingest, whose rows can be
+    recomputed if they're lost."""
+    global bulk_depth
+    bulk_depth += 1
+    try:
+        conn = db.session.connection().connection
+        set_synchronous(conn, conn.info)
+        yield
+    finally:
+        bulk_depth -= 1
+        conn = db.session.connection().connection
+        set_synchronous(conn, conn.info)
+
+
+def migrate():
+    """Add model columns and indexes that are missing from existing tables (``create_all`` only creates missing
+    tables)."""
+    inspector = inspect(db.engine)
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            columns = { c['name'] for c in inspector.get_columns(table.name) }
+            for column in table.columns:
+                if column.name not in columns:
+                    type = column.type.compile(dialect=db.engine.dialect)
+                    conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {type}'))
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
@@ -0,0 +1,98 @@
+"""Read S3 event notification records (as delivered to SQS/SNS/Lambda, or saved from them) from files or stdin."""
+import json
+import sys
+from urllib.parse import unquote_plus
+
+from . import s3
+
+CREATED, REMOVED = 'created', 'removed'
+# Records to collapse and apply at a time
+BATCH_SIZE = 10_000
+
+
+def documents(paths):
+    """JSON documents in ``paths`` (``-`` is stdin): each file holds one document, or one per line."""
+    for path in paths:
+        f = sys.stdin if path == '-' else open(path, 'r')
+        try:
+            text = f.read()
+        finally:
+            if f is not sys.stdin:
+                f.close()
+        try:
+            yield json.loads(text)
+        except json.JSONDecodeError:
+            for line in text.splitlines():
+                if line.strip():
+                    yield json.loads(line)
+
+
+def records(doc):
+    """S3 event records in ``doc``: a ``{"Records": […]}`` notification, a single record, a list of either, or an SNS/SQS
+    envelope (whose ``Message``/``Body`` is a JSON string of one of those)."""
+    if isinstance(doc, list):
+        for d in doc:
+            yield from records(d)
+    elif 'Records' in doc:
+        for record in doc['Records']:
+            yield from records(record)
+    elif 's3' in doc and 'eventName' in doc:
+        yield doc
+    else:
+        for k in [ 'Message', 'Body', 'body' ]:
+            if isinstance(doc.get(k), str):
+                yield from records(json.loads(doc[k]))
+                break
+
+
+def sequence(record, i):
+    """Sort key ordering events on the same object key: ``sequencer`` (hex strings, compared after right-padding the
+    shorter with zeros), then order of appearance."""
+    return record['s3']['object'].get('sequencer', '').ljust(32, '0'), i
+
+
+def events(paths, bucket):
+    """Yield batches of ``{key: (CREATED|REMOVED, size, event time)}`` for ``bucket``'s objects, each key's latest event
+    (by ``sequencer``) so far: notifications arrive unordered, so events older than one already yielded (in an earlier
+    batch, or file) for the same key are dropped."""
+    batch = {}
+    # Each key's latest sequence (batched or yielded)
+    latest = {}
+    for i, record in enumerate(r for doc in documents(paths) for r in records(doc)):
+        if record['s3']['bucket']['name'] != bucket:
+            continue
+        name = record['eventName']
+        if name.startswith('ObjectCreated:'):
+            kind = CREATED
+        elif name.startswith('ObjectRemoved:'):
+            kind = REMOVED
+        else:
+            continue
+        obj = record['s3']['object']
+        # Keys are URL-encoded
+        key = unquote_plus(obj['key'])
+        seq = sequence(record, i)
+        cur = latest.get(key)
+        if cur is None or cur < seq:
+            latest[key] = seq
+            batch[key] = (seq, kind, obj.get('size', 0), record['eventTime'])
+            if len(batch) >= BATCH_SIZE:
+                yield finish(batch)
+                batch = {}
+    if batch:
+        yield finish(batch)
+
+
+def finish(batch):
+    keys = list(batch)
+    mtimes = s3.utc_mtimes([ batch[key][3] for key in keys ]).astype('int64')
+    return { key: (batch[key][1], batch[key][2], int(mtime)) for key, mtime in zip(keys, mtimes) }
+
+
+def ancestors(key):
+    """``key``'s parent "directories", from the nearest up to the bucket root (``''``)."""
+    rv = []
+    while key:
+        key = key.rpartition('/')[0]
+        rv.append(key)
+    return rv
@@ -0,0 +1,110 @@
+"""Read S3 Inventory reports (a ``manifest.json``, plus its CSV, ORC or Parquet data files) from local disk."""
+from os.path import basename, dirname, exists, join
+
+import json
+import pandas as pd
+import re
+from urllib.parse import unquote_plus
+
+from . import s3
+
+# Rows to read from a data file at a time
+CHUNK_SIZE = 1_000_000
+COLUMNS = [ 'key', 'size', 'last_modified_date', 'is_latest', 'is_delete_marker' ]
+
+
+def snake_case(name):
+    """``fileSchema`` names (``"LastModifiedDate"``) as ORC/Parquet columns are named (``"last_modified_date"``)."""
+    return re.sub(r'(?<!^)(?=[A-Z][a-z])', '_', name.strip()).lower()
+
+
+class Manifest:
+    """An S3 Inventory ``manifest.json``; ``blocks`` yields its objects' keys, sizes and mtimes (in the form that
+    ``s3.read_listing`` does), read a chunk at a time with a columnar reader.
+
+    Data files are looked up (by the destination-bucket keys listed in the manifest) next to the manifest, in a
+    ``data/`` directory beside the manifest's directory (the layout S3 Inventory writes), or at the full key under any
+    of the manifest's ancestor directories.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'r') as f:
+            manifest = json.load(f)
+        self.bucket = manifest['sourceBucket']
+        self.file_format = manifest['fileFormat'].upper()
+        if self.file_format not in { 'CSV', 'ORC', 'PARQUET' }:
+            raise ValueError(f'Unsupported S3 Inventory format: {manifest["fileFormat"]}')
+        self.schema = [ snake_case(name) for name in manifest['fileSchema'].split(',') ] if self.file_format == 'CSV' else None
+        # Inventories are snapshots as of their creation time, in ms since the epoch
+        created = pd.Timestamp(int(manifest['creationTimestamp']), unit='ms', tz='UTC')
+        self.created = created
+        self.created_ns = created.value
+        self.files = [ self.data_path(file['key']) for file in manifest['files'] ]
+
+    def data_path(self, key):
+        manifest_dir = dirname(self.path)
+        name = basename(key)
+        candidates = [ join(manifest_dir, name), join(dirname(manifest_dir), 'data', name) ]
+        ancestor = manifest_dir
+        while True:
+            candidates.append(join(ancestor, key))
+            if dirname(ancestor) == ancestor:
+                break
+            ancestor = dirname(ancestor)
+        for candidate in candidates:
+            if exists(candidate):
+                return candidate
+        raise FileNotFoundError(f'S3 Inventory data file {key} (from {self.path}) not found locally')
+
+    def read_csv(self, path):
+        columns = [ c for c in COLUMNS if c in self.schema ]
+        chunks = pd.read_csv(
+            path,
+            header=None,
+            names=self.schema,
+            usecols=columns,
+            dtype={ 'key': str, 'is_latest': str, 'is_delete_marker': str },
+            keep_default_na=False,
+            na_values={ 'size': [ '' ] },
+            chunksize=CHUNK_SIZE,
+        )
+        for chunk in chunks:
+            keys = chunk['key']
+            # CSV inventories URL-encode keys
+            encoded = keys.str.contains('[%+]', regex=True)
+            if encoded.any():
+                keys = keys.where(~encoded, keys[encoded].map(unquote_plus))
+            chunk['key'] = keys
+            for flag in [ 'is_latest', 'is_delete_marker' ]:
+                if flag in chunk:
+                    chunk[flag] = chunk[flag].str.lower() == 'true'
+            yield chunk
+
+    def read_parquet(self, path):
+        import pyarrow.parquet as pq
+        file = pq.ParquetFile(path)
+        columns = [ c for c in COLUMNS if c in file.schema_arrow.names ]
+        for batch in file.iter_batches(batch_size=CHUNK_SIZE, columns=columns):
+            yield batch.to_pandas()
+
+    def read_orc(self, path):
+        import pyarrow.orc as orc
+        file = orc.ORCFile(path)
+        columns = [ c for c in COLUMNS if c in file.schema.names ]
+        for stripe in range(file.nstripes):
+            yield file.read_stripe(stripe, columns=columns).to_pandas()
+
+    def blocks(self):
+        read = dict(CSV=self.read_csv, ORC=self.read_orc, PARQUET=self.read_parquet)[self.file_format]
+        for path in self.files:
+            for chunk in read(path):
+                # Versioned inventories also list noncurrent versions and delete markers
+                if 'is_latest' in chunk:
+                    chunk = chunk[chunk['is_latest'].fillna(True).astype(bool)]
+                if 'is_delete_marker' in chunk:
+                    chunk = chunk[~chunk['is_delete_marker'].fillna(False).astype(bool)]
+                yield pd.DataFrame({
+                    'mtime': s3.utc_mtimes(chunk['last_modified_date']),
+                    'size': chunk['size'].fillna(0).astype('int64'),
+                    'key': chunk['key'],
+                })
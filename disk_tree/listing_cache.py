@@ -0,0 +1,107 @@
+"""Compact binary cache of S3 listings: zlib-compressed columnar chunks, with front-coded keys and int64 sizes/mtimes.
+
+A file is ``MAGIC``, followed by chunks (each decodable on its own) of:
+
+- a ``HEADER``: the chunk's number of keys, and compressed length;
+- its zlib-compressed columns: mtimes (int64 seconds since the epoch, UTC), sizes (int64), then each key's length of prefix
+  shared with the previous key, and of the remaining suffix (uint32 code points), then the suffixes (UTF-8, concatenated).
+"""
+from itertools import accumulate
+
+import numpy as np
+import os
+import pandas as pd
+import struct
+import zlib
+
+from . import s3
+
+MAGIC = b'DTLS\x01'
+HEADER = struct.Struct('<QQ')
+LEVEL = 6
+# Max. key-characters to compare at a time (when computing shared prefixes)
+PREFIX_BLOCK = 1 << 24
+
+
+def shared_prefixes(keys):
+    """Length of the prefix that each of ``keys`` shares with the one before it (0 for the first)."""
+    shared = np.zeros(len(keys), dtype=np.uint32)
+    lens = np.fromiter(map(len, keys), dtype=np.uint32, count=len(keys))
+    width = int(lens.max(initial=1)) or 1
+    step = max(PREFIX_BLOCK // width, 2)
+    # Overlapping ranges, so that each key (but the first) is compared with its predecessor
+    for start in range(0, max(len(keys) - 1, 0), step - 1):
+        chars = np.array(keys[start:start + step], dtype=f'U{width}').view(np.uint32).reshape(-1, width)
+        equal = chars[1:] == chars[:-1]
+        mismatch = np.where(equal.all(axis=1), width, equal.argmin(axis=1))
+        shared[start + 1:start + len(chars)] = np.minimum(mismatch, np.minimum(lens[start + 1:start + len(chars)], lens[start:start + len(chars) - 1]))
+    return shared
+
+
+def encode(files):
+    """One chunk (``HEADER`` + compressed columns) for a DataFrame of ``mtime``s, ``size``s and ``key``s."""
+    keys = files['key'].tolist()
+    shared = shared_prefixes(keys)
+    suffixes = [ key[n:] for key, n in zip(keys, shared.tolist()) ]
+    suffix_lens = np.fromiter(map(len, suffixes), dtype=np.uint32, count=len(suffixes))
+    mtimes = files['mtime'].to_numpy().astype('datetime64[s]').astype(np.int64)
+    sizes = files['size'].to_numpy().astype(np.int64)
+    payload = b''.join([ mtimes.tobytes(), sizes.tobytes(), shared.tobytes(), suffix_lens.tobytes(), ''.join(suffixes).encode() ])
+    compressed = zlib.compress(payload, LEVEL)
+    return HEADER.pack(len(keys), len(compressed)) + compressed
+
+
+def decode(n, payload):
+    """Inverse of ``encode`` (given its number of keys and decompressed columns)."""
+    mtimes = np.frombuffer(payload, dtype=np.int64, count=n)
+    sizes = np.frombuffer(payload, dtype=np.int64, count=n, offset=8 * n)
+    shared = np.frombuffer(payload, dtype=np.uint32, count=n, offset=16 * n)
+    suffix_lens = np.frombuffer(payload, dtype=np.uint32, count=n, offset=20 * n)
+    text = payload[24 * n:].decode()
+    ends = np.cumsum(suffix_lens, dtype=np.int64)
+    starts = ends - suffix_lens
+    keys = accumulate(
+        zip(shared.tolist(), starts.tolist(), ends.tolist()),
+        lambda prev, cur: prev[:cur[0]] + text[cur[1]:cur[2]],
+        initial='',
+    )
+    next(keys)
+    return pd.DataFrame({
+        'mtime': mtimes.astype('datetime64[s]').astype('datetime64[ns]'),
+        'size': sizes.copy(),
+        'key': list(keys),
+    })
+
+
+def write(path, blocks):
+    """Write ``blocks`` (DataFrames, as ``s3.read_listing`` yields) to ``path`` (via a temporary file), one chunk each."""
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        for files in blocks:
+            if len(files):
+                f.write(encode(files))
+    os.replace(tmp_path, path)
+
+
+def read(path):
+    """Yield ``path``'s chunks as DataFrames with ``mtime``, ``size`` and ``key`` columns."""
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{path} is not a listing cache')
+        while True:
+            header = f.read(HEADER.size)
+            if not header:
+                break
+            n, size = HEADER.unpack(header)
+            yield decode(n, zlib.decompress(f.read(size)))
+
+
+def migrate(txt_path, path):
+    """Convert an ``aws s3 ls --recursive``-style listing at ``txt_path`` to a listing cache at ``path`` (with the same
+    mtime, which the cache's TTL is checked against), and remove ``txt_path``."""
+    stat = os.stat(txt_path)
+    # `aws s3 ls` shows local times
+    write(path, ( files.assign(mtime=s3.local_to_utc(files['mtime'])) for files in s3.read_listing(txt_path) ))
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    os.remove(txt_path)
@@ -13,68 +13,19 @@ from sys import stderr
 from tempfile import NamedTemporaryFile
 from typing import Optional
 from urllib.parse import ParseResult
-from utz import basename, concat, DF, dirname, env, process, singleton, sxs, urlparse, err
+from utz import basename, dirname, env, process, urlparse, err
 
 from disk_tree.config import SQLITE_PATH
-from disk_tree.db import init
+from disk_tree.db import init, migrate
+from disk_tree.s3_list import DEFAULT_JOBS as DEFAULT_S3_JOBS
+from disk_tree.scan import DEFAULT_CHECKPOINT_INTERVAL
+from disk_tree.scan_async import DEFAULT_CONCURRENCY
+from disk_tree.stats import ScanStats
+from disk_tree.tree import FILE
 
 LINE_RGX = r'(?P<mtime>\d{4}-\d{2}-\d{2} \d\d:\d\d:\d\d) +(?P<size>\d+) (?P<key>.*)'
 
 
-def dirs(file, root=None):
-    rv = [file]
-    cur = file
-    while True:
-        dir = dirname(cur)
-        if dir == cur:
-            break
-        else:
-            rv.append(dir)
-            cur = dir
-            if root and cur == root:
-                break
-    return list(reversed(rv))
-
-
-def flatmap(self, func, **kwargs):
-    dfs = []
-    for idx, row in self.iterrows():
-        df = func(row, **kwargs)
-        dfs.append(df)
-    return concat(dfs)
-
-
-DF.flatmap = flatmap
-
-
-def expand_file_row(r, k, root=None):
-    path = r[k]
-    file_df = r.to_frame().transpose()
-    ancestors = dirs(path, root=root)[:-1]
-
-    def to_dict(dir):
-        rv = dict(mtime=r['mtime'], size=r['size'], type='dir', parent=dirname(dir))
-        rv[k] = dir
-        return rv
-    dirs_df = DF([ to_dict(dir) for dir in ancestors ])
-    rows = concat([file_df, dirs_df]).reset_index(drop=True)
-    return rows
-
-
-def agg_dirs(files, k='path', root=None,):
-    files['type'] = 'file'
-    expanded = files.flatmap(expand_file_row, k=k, root=root)
-    groups = expanded.groupby([ k, 'type' ])
-    if len(groups) == len(files):
-        return files
-    sizes = groups['size'].sum()
-    mtimes = groups['mtime'].max()
-    parents = groups.apply(lambda df: singleton(df['parent'])).rename('parent')
-    num_descendants = groups.size().rename('num_descendants')
-    aggd = sxs(mtimes, sizes, num_descendants, parents).reset_index()
-    return aggd
-
-
 def load_file(url: str, cache: 'Cache', fsck: bool = False, excludes: Optional[list[str]] = None):
     # Local filesystem
     root = url
@@ -82,60 +33,98 @@ def load_file(url: str, cache: 'Cache', fsck: bool = False, excludes: Optional[l
         excludes = [ abspath(exclude) for exclude in excludes ]
         print(f'excludes: {excludes}')
     root = cache.compute_file(root, fsck=fsck, excludes=excludes)
-    entries = root.descendants(excludes=excludes)
-    keys = [ 'path', 'kind', 'size', 'mtime', 'num_descendants', 'parent', 'checked_at', ]
-    df = DF([
-        { k: getattr(e, k) for k in keys }
-        for e in entries
-    ])
-    return df.set_index('path')
-
+    if cache.skipped_mounts:
+        excludes = (excludes or []) + cache.skipped_mounts
+    return cache.tree(root, excludes=excludes)
 
-def make_s3_url(r):
-    return f's3://{r.bucket}/{r.key}' if r.key else f's3://{r.bucket}'
 
-
-def load_s3(url: str, parsed: ParseResult, cache: 'Cache', profile: str = None, excludes: Optional[list[str]] = None):
+def load_s3(url: str, parsed: ParseResult, cache: 'Cache', profile: str = None, excludes: Optional[list[str]] = None, inventory: Optional[str] = None, events: Optional[list[str]] = None):
     if profile:
         env['AWS_PROFILE'] = profile
     bucket = parsed.netloc
     root_key = parsed.path
     if root_key and root_key[0] == '/':
         root_key = root_key[1:]
-    root = cache.compute_s3(url=url, bucket=bucket, root_key=root_key)
-    entries = root.descendants(excludes=excludes)
-    keys = [ 'bucket', 'key', 'kind', 'size', 'mtime', 'num_descendants', 'parent', 'checked_at', ]
-    df = DF([
-        { k: getattr(e, k) for k in keys }
-        for e in entries
-    ])
-    df['url'] = df.apply(make_s3_url, axis=1)
-    return df.set_index(['bucket', 'key'])
+    if events:
+        root = cache.compute_s3_events(url=url, bucket=bucket, root_key=root_key, paths=events)
+    elif inventory:
+        root = cache.compute_s3_inventory(url=url, bucket=bucket, root_key=root_key, manifest_path=inventory)
+    else:
+        root = cache.compute_s3(url=url, bucket=bucket, root_key=root_key)
+    return cache.tree(root, excludes=excludes)
+
+
+def load_cached(path: str, cache: 'Cache', excludes: Optional[list[str]] = None):
+    """Tree of ``path``'s cached rows (however old), without scanning, listing, or writing anything."""
+    root = cache.node(path)
+    if root is None:
+        raise ValueError(f'{path} is not cached')
+    return cache.tree(root, excludes=excludes)
 
 
 @command('disk-tree')
+@option('-a', '--async-scan', is_flag=True, help='`file` scheme only: scan directories with an asyncio event loop, keeping many scandir/stat calls in flight at once (for high-latency network filesystems)')
+@option('-b', '--batch-size', type=int, help='Number of rows to buffer before writing them to the cache DB in one transaction; default: 10000')
 @option('-c', '--color', help='Plotly treemap color configs: "name", "size", "size=<color-scale>" (cf. https://plotly.com/python/builtin-colorscales/#builtin-sequential-color-scales)')
 @option('-C', '--cache-path', help=f'Path to SQLite DB (or directory containing disk-tree.db) to use as cache; default: {SQLITE_PATH}')
+@option('-e', '--events', multiple=True, help='`s3` scheme only: apply S3 event notification records (ObjectCreated/ObjectRemoved; as JSON, one document per file or per line) from these files ("-" for stdin) to the cached listing, propagating size/count changes to ancestor prefixes, instead of relisting the bucket; can be passed multiple times')
 @option('-f', '--fsck', count=True, help='`file` scheme only: validate all cache entries that begin with the provided path(s); when passed twice, exit after performing fsck')
+@option('-i', '--incremental', is_flag=True, help="`file` scheme only: when rescanning expired cache entries, skip listing directories whose mtime/ctime haven't changed (re-stat'ing their cached children instead), and skip writing unchanged rows")
+@option('-I', '--inventory', help='`s3` scheme only: populate the cache from this S3 Inventory `manifest.json` (with its CSV/ORC/Parquet data files alongside, as S3 Inventory lays them out, on local disk), instead of listing the bucket; ORC/Parquet require `pyarrow`')
+@option('-j', '--jobs', type=int, help=f'Number of threads to list/stat directories with (default: 1, single-threaded), or to list S3 key-range shards with (default: {DEFAULT_S3_JOBS})')
+@option('-J', '--stats-json', help='`file` scheme only: write scan throughput/latency stats (see -S/--stats) to this JSON file')
+@option('-k', '--checkpoint-interval', type=float, default=DEFAULT_CHECKPOINT_INTERVAL, help=f'`file` scheme only: seconds between checkpoints of an in-progress scan (completed rows, plus the directories still being scanned), from which an interrupted scan resumes, skipping subdirectories completed within the cache TTL; 0 only checkpoints on interruption; default: {DEFAULT_CHECKPOINT_INTERVAL}')
+@option('-L', '--concurrency', 'concurrency_limits', multiple=True, help=f'Limit on concurrent directory scans with -a/--async-scan (implied): "<N>" sets the default (default: {DEFAULT_CONCURRENCY}), "<mountpoint>=<N>" sets a per-mount limit; can be passed multiple times')
 @option('-m', '--max-entries', default='10k', help='Only store/render the -m/--max-entries largest directories/files found; default: "10k"')
 @option('-M', '--no-max-entries', is_flag=True, help='Show all directories/files, ignore -m/--max-entries')
 @option('-n', '--sort-by-name', is_flag=True, help='Sort output entries by name (default is by size)')
 @option('-o', '--out-path', multiple=True, help='Paths to write output to. Supported extensions: {jpg, png, svg, html}')
 @option('-O', '--no-open', is_flag=True, help='Skip attempting to `open` any output files')
 @option('-p', '--profile', help='AWS_PROFILE to use')
+@option('-r', '--read-only', is_flag=True, help="Render from the cache as it is (however old), opening it read-only, without scanning, listing, or writing anything (e.g. while another `disk-tree` process is scanning into it)")
 @option('-s', '--size-mode', count=True, help='Pass once for SI units, twice for raw sizes')
+@option('-S', '--stats', 'print_stats', is_flag=True, help='`file` scheme only: print a summary of scan throughput (entries/s), stat/scandir latency histograms, DB vs. filesystem time, and the slowest directories')
 @option('-t', '--cache-ttl', default='1d', help='TTL for cache entries; default: "1d"')
 @option('-T', '--tmp-html', count=True, help='Write an HTML representation to a temporary file and open in browser; pass twice to keep the temp file around after exit')
 @option('-x', '--exclude', 'excludes', multiple=True, help='Exclude paths')
+@option('-X', '--one-file-system', is_flag=True, help="`file` scheme only: don't descend into directories on other filesystems than the root (e.g. mountpoints under `/`)")
 @argument('url', required=False)
-def cli(url, color, cache_path, fsck, max_entries, no_max_entries, sort_by_name, out_path, no_open, profile, size_mode, cache_ttl, tmp_html, excludes):
+def cli(url, async_scan, batch_size, color, cache_path, events, fsck, incremental, inventory, jobs, checkpoint_interval, stats_json, concurrency_limits, max_entries, no_max_entries, sort_by_name, out_path, no_open, profile, read_only, size_mode, print_stats, cache_ttl, tmp_html, excludes, one_file_system):
     from disk_tree.config import ROOT_DIR
-    db = init(cache_path)
-    db.create_all()
+    if read_only and (events or fsck or inventory):
+        raise ValueError('-r/--read-only is incompatible with -e/--events, -f/--fsck, and -I/--inventory')
+    db = init(cache_path, read_only=read_only)
 
     from disk_tree.cache import Cache
-
-    cache = Cache(ttl=pd.to_timedelta(cache_ttl))
+    from disk_tree.model import migrate_legacy, s3_path
+    if not read_only:
+        db.create_all()
+        migrate()
+        migrate_legacy()
+
+    concurrency = None
+    mount_concurrency = {}
+    for limit in concurrency_limits:
+        pcs = limit.rsplit('=', 1)
+        if len(pcs) == 2:
+            mount, n = pcs
+            mount_concurrency[abspath(mount)] = int(n)
+        else:
+            concurrency = int(limit)
+
+    stats = ScanStats() if print_stats or stats_json else None
+    cache = Cache(
+        ttl=pd.to_timedelta(cache_ttl),
+        jobs=jobs,
+        batch_size=batch_size,
+        incremental=incremental,
+        aio=async_scan or bool(concurrency_limits),
+        concurrency=concurrency,
+        mount_concurrency=mount_concurrency,
+        one_file_system=one_file_system,
+        checkpoint_interval=checkpoint_interval,
+        stats=stats,
+    )
 
     if fsck:
         cache.fsck()
@@ -152,25 +141,35 @@ def cli(url, color, cache_path, fsck, max_entries, no_max_entries, sort_by_name,
         url = url[:-1]
 
     parsed = urlparse(url)
-    if not parsed.scheme or parsed.scheme == 'file':
+    if read_only:
+        if not parsed.scheme or parsed.scheme == 'file':
+            url = abspath(url)
+            path = url
+            excludes = [ abspath(exclude) for exclude in excludes ]
+        elif parsed.scheme == 's3':
+            path = s3_path(parsed.netloc, parsed.path.lstrip('/'))
+        else:
+            raise ValueError(f'Unsupported URL scheme: {parsed.scheme}')
+        tree = load_cached(path, cache=cache, excludes=excludes)
+    elif not parsed.scheme or parsed.scheme == 'file':
         url = abspath(url)
-        df = load_file(url, cache=cache, fsck=fsck, excludes=excludes).reset_index()
+        tree = load_file(url, cache=cache, fsck=fsck, excludes=excludes)
+        if stats:
+            stats.print_summary()
+            if stats_json:
+                err(f'Writing scan stats: {stats_json}')
+                stats.write_json(stats_json)
     elif parsed.scheme == 's3':
-        df = load_s3(url, parsed=parsed, cache=cache, profile=profile, excludes=excludes).reset_index()
+        tree = load_s3(url, parsed=parsed, cache=cache, profile=profile, excludes=excludes, inventory=inventory, events=events)
     else:
         raise ValueError(f'Unsupported URL scheme: {parsed.scheme}')
 
-    k = 'path' if 'path' in df else 'key'
-    df['name'] = df[k].apply(basename)
-
     if size_mode == 0:
         size_col = 'hsize'
         size2str = partial(naturalsize, gnu=True)
-        df['hsize'] = df['size'].apply(size2str)
     elif size_mode == 1:
         size_col = 'hsize'
         size2str = partial(naturalsize)
-        df['hsize'] = df['size'].apply(size2str)
     elif size_mode == 2:
         size2str = lambda x: x
         size_col = 'size'
@@ -190,30 +189,31 @@ def cli(url, color, cache_path, fsck, max_entries, no_max_entries, sort_by_name,
     if no_max_entries or max_entries == 0:
         max_entries = None
 
-    files, dirs = df[df.kind == 'file'], df[df.kind == 'dir']
-    total_size = files['size'].sum()
+    is_file = tree.kind == FILE
+    num_files = is_file.sum()
+    total_size = tree.size[is_file].sum()
     total_size_str = size2str(total_size)
-    err(f'{len(files)} files in {len(dirs)} dirs, total size {total_size_str}')
+    err(f'{num_files} files in {len(tree) - num_files} dirs, total size {total_size_str}')
 
-    if max_entries and len(df) > max_entries:
-        err(f'Reducing to top entries ({len(df)} → {max_entries})')
-        df = df.sort_values('size')
-        df = df.iloc[-max_entries:]
+    if max_entries and len(tree) > max_entries:
+        err(f'Reducing to top entries ({len(tree)} → {max_entries})')
+        df = tree.to_df(tree.largest(max_entries))
         if sort_by_name:
             df = df.sort_values('name')
     else:
+        df = tree.to_df()
         if sort_by_name:
             df = df.sort_values('name')
         else:
             df = df.sort_values('size')
 
-    if 'key' in df:
-        df.loc[df['key'] == '', 'key'] = url
-        df.loc[df['parent'] == '', 'parent'] = url
-        is_root = df['url'] == url
-        df.loc[is_root, ('parent', 'name')] = ('', url)
-    else:
-        df.loc[df['path'] == url, 'parent'] = ''
+    # S3 trees' paths are keys; identify the root by its URL
+    root_path = tree.paths([0])[0]
+    df.loc[df['parent'] == root_path, 'parent'] = url
+    is_root = df['path'] == root_path
+    df.loc[is_root, ('path', 'parent', 'name')] = (url, '', url if parsed.scheme == 's3' else basename(url))
+    if size_col == 'hsize':
+        df['hsize'] = df['size'].apply(size2str)
 
     df['label'] = df.apply(lambda r: f'{r["name"]}: {r[size_col]}', axis=1)
     # df.loc[df.parent == url, 'parent'] = f'{url}: {total_size_str}'
@@ -241,7 +241,7 @@ def cli(url, color, cache_path, fsck, max_entries, no_max_entries, sort_by_name,
 
         fig = px.treemap(
             df,
-            ids=k,
+            ids='path',
             names='label',
             # textinfo='name',
             parents='parent',
@@ -291,7 +291,7 @@ def cli(url, color, cache_path, fsck, max_entries, no_max_entries, sort_by_name,
         remove(tmp_html_path)
 
     children = df[df.parent == url]
-    lines = children.apply(lambda r: '% 8s\t%s' % (r[size_col], r[k]), axis=1, result_type='reduce').tolist()
+    lines = children.apply(lambda r: '% 8s\t%s' % (r[size_col], r['path']), axis=1, result_type='reduce').tolist()
     print('\n'.join(lines))
 
 
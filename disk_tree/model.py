@@ -1,56 +1,315 @@
 from typing import Optional
 
+from sqlalchemy import String, and_, bindparam, case, inspect, literal, select, text, true, tuple_
+from sqlalchemy.orm import aliased
+from utz import err
+
 from .db import db
 
+TREE_ROWS_BATCH_SIZE = 10_000
+# Nodes per `IN (…)` query (SQLite limits the number of bound parameters)
+IN_BATCH_SIZE = 500
+# Legacy rows to migrate per transaction
+MIGRATE_BATCH_SIZE = 100_000
 
-class File(db.Model):
-    path = db.Column(db.String, primary_key=True)
-    mtime = db.Column(db.DateTime, nullable=False)
-    size = db.Column(db.Integer, nullable=False)
-    parent = db.Column(db.String, nullable=True)
-    kind = db.Column(db.String, nullable=False)
-    num_descendants = db.Column(db.Integer, nullable=False)
-    checked_at = db.Column(db.DateTime, nullable=False)
+# `parent_id` of root nodes: "/" (local paths), and "s3://<bucket>/" (each S3 bucket)
+ROOT = 0
+S3_SCHEME = 's3://'
+# Timestamps (`mtime`, `checked_at`) are stored as integer ns since the epoch
+EPOCH = 0
+# Directories inserted (as ancestors of other rows) before their own rows are; never fresh
+PLACEHOLDER = dict(kind='dir', mtime=EPOCH, size=0, num_descendants=0, checked_at=EPOCH)
 
-    def __repr__(self):
-        return f'File({self.path})'
 
-    def descendants(self, excludes: Optional[list[str]] = None):
-        filter = (File.parent == self.path) | File.parent.startswith(f'{self.path}/')
-        if excludes:
-            filter = filter & File.path.not_in(excludes) & File.parent.not_in(excludes)
-            for exclude in excludes:
-                filter = filter & ~File.parent.startswith(f'{exclude}/')
-        return [self] + self.query.filter(filter).all()
+def s3_root(bucket):
+    return f'{S3_SCHEME}{bucket}/'
+
+
+def s3_path(bucket, key):
+    """Node path of ``bucket``'s ``key`` (``''`` is the bucket's root)."""
+    return f'{s3_root(bucket)}{key}'
+
+
+def root_of(path):
+    """Name of ``path``'s root node: ``/``, or ``s3://<bucket>/``."""
+    if path.startswith(S3_SCHEME):
+        return s3_root(path[len(S3_SCHEME):].partition('/')[0])
+    return '/'
+
+
+def s3_key(path):
+    return path[len(root_of(path)):]
+
+
+def split(path):
+    """``path``'s parent's path and its basename (``None`` and ``path``, for a root)."""
+    root = root_of(path)
+    if path == root:
+        return None, path
+    head, _, name = path.rpartition('/')
+    return (head if len(head) >= len(root) else root), name
+
+
+def is_placeholder(row):
+    return row.checked_at == EPOCH
+
+
+def resolve(paths, ids=None, create=False):
+    """Rows of the nodes at ``paths`` (those that exist), by path.
+
+    Paths are resolved one level at a time from the nearest ancestor whose id is memoized in ``ids`` (which is updated),
+    with one indexed ``(parent_id, name)`` lookup per node; with ``create``, missing nodes (and ancestors) are inserted
+    first, as ``PLACEHOLDER`` directories."""
+    ids = {} if ids is None else ids
+    paths = set(paths)
+    todo = {}
+    for path in paths:
+        while path is not None and path not in ids and path not in todo:
+            todo[path] = parent = split(path)[0]
+            path = parent
+    rows = {}
+    while todo:
+        level = [ path for path, parent in todo.items() if parent is None or parent in ids ]
+        if not level:
+            # The rest are under missing ancestors
+            break
+        keys = { (ROOT if todo[path] is None else ids[todo[path]], split(path)[1]): path for path in level }
+        for _ in range(2 if create else 1):
+            missing = [ key for key in keys if keys[key] not in ids ]
+            for i in range(0, len(missing), IN_BATCH_SIZE):
+                chunk = missing[i:i + IN_BATCH_SIZE]
+                for row in db.session.execute(BY_KEYS, dict(keys=chunk)):
+                    path = keys[(row.parent_id, row.name)]
+                    ids[path] = row.id
+                    rows[path] = row
+            missing = [ key for key in keys if keys[key] not in ids ]
+            if not create or not missing:
+                break
+            db.session.execute(INSERT_PLACEHOLDERS, [ dict(parent_id=parent_id, name=name, **PLACEHOLDER) for parent_id, name in missing ])
+        for path in level:
+            del todo[path]
+        todo = { path: parent for path, parent in todo.items() if parent is None or parent in ids or parent in todo }
+    # Memoized paths' rows
+    known = [ path for path in paths if path in ids and path not in rows ]
+    by_id = { ids[path]: path for path in known }
+    for i in range(0, len(known), IN_BATCH_SIZE):
+        chunk = [ ids[path] for path in known[i:i + IN_BATCH_SIZE] ]
+        for row in db.session.execute(BY_IDS, dict(ids=chunk)):
+            rows[by_id[row.id]] = row
+    for path in known:
+        if path not in rows:
+            # Deleted since it was memoized
+            del ids[path]
+    return { path: row for path, row in rows.items() if path in paths }
+
+
+def subtree(id, path, filter=None, descend=None):
+    """Recursive CTE of node ``id`` (at ``path``) and its descendants, with all ``Node`` columns, plus each one's full
+    ``path`` (built from its ancestors' names). ``filter(child)`` restricts the descendants included, and
+    ``descend(sub)`` the rows whose children are (beyond the root).
+
+    Rows are generated breadth-first, so each one's parent precedes it."""
+    cols = Node.__table__.columns
+    sub = select(*cols, literal(path).label('path')).where(Node.id == id).cte(recursive=True)
+    child = aliased(Node, name='child')
+    where = child.parent_id == sub.c.id
+    if filter is not None:
+        where = where & filter(child)
+    if descend is not None:
+        where = where & ((sub.c.id == id) | descend(sub))
+    child_path = case((sub.c.parent_id == ROOT, sub.c.path + child.name), else_=sub.c.path + '/' + child.name)
+    return sub.union_all(select(*[ getattr(child, c.name) for c in cols ], child_path).where(where))
 
 
+def subtree_ids(ids):
+    """Ids of nodes ``ids`` and their descendants (a recursive CTE over ``parent_id``)."""
+    sub = select(Node.id).where(Node.id.in_(ids)).cte(recursive=True)
+    child = aliased(Node, name='child')
+    sub = sub.union_all(select(child.id).where(child.parent_id == sub.c.id))
+    return select(sub.c.id)
 
-class S3(db.Model):
-    bucket = db.Column(db.String, primary_key=True)
-    key = db.Column(db.String, primary_key=True)
-    mtime = db.Column(db.DateTime, nullable=False)
+
+class Node(db.Model):
+    """A cached file, directory, S3 object, or S3 "directory" (key prefix).
+
+    Rows store only their basename, under their parent's ``id``; full paths (``/…`` for local files, ``s3://<bucket>/…``
+    for S3) are rebuilt from ancestors' names (see ``resolve`` and ``subtree``) only where needed."""
+    id = db.Column(db.Integer, primary_key=True)
+    parent_id = db.Column(db.Integer, nullable=False)
+    name = db.Column(db.String, nullable=False)
+    # ns since the epoch
+    mtime = db.Column(db.Integer, nullable=False)
     size = db.Column(db.Integer, nullable=False)
-    parent = db.Column(db.String, nullable=True)
     kind = db.Column(db.String, nullable=False)
     num_descendants = db.Column(db.Integer, nullable=False)
-    checked_at = db.Column(db.DateTime, nullable=False)
+    checked_at = db.Column(db.Integer, nullable=False)
+    # Directories' own stat times, used to detect unchanged listings during incremental rescans
+    st_mtime_ns = db.Column(db.Integer, nullable=True)
+    st_ctime_ns = db.Column(db.Integer, nullable=True)
+    # Nested (pre-order) interval: this row's subtree is the rows with `lo` in `[lo, hi]` (see `Cache.number_subtree`),
+    # and the subtrees of any unnumbered rows under them (see `Node.ranged`); upserts of rows that don't set them keep
+    # the existing values
+    lo = db.Column(db.Integer, nullable=True, index=True, info=dict(preserve=True))
+    hi = db.Column(db.Integer, nullable=True, index=True, info=dict(preserve=True))
+
+    # Children are looked up (and rows upserted) by (parent_id, name)
+    __table_args__ = (
+        db.Index('ix_node_parent_id_name', 'parent_id', 'name', unique=True),
+        dict(info=dict(upsert_key=('parent_id', 'name'))),
+    )
+
+    def __repr__(self):
+        return f'Node({self.id}: {self.name})'
 
-    # Used by `self.descendants`
     @property
-    def path(self):
-        return self.key
+    def numbered(self):
+        return self.lo is not None
+
+    def unnumbered(self):
+        """Unnumbered rows whose parents are in this (numbered) row's range; their subtrees are outside it. They're written
+        by scans that didn't complete (rows are numbered once their directory's scan does), or are placeholders."""
+        parent = aliased(Node, name='parent')
+        return select(Node.id).join(parent, Node.parent_id == parent.id).where(Node.lo.is_(None) & parent.lo.between(self.lo, self.hi))
+
+    @property
+    def ranged(self):
+        """Whether this row's subtree is exactly its range of ``lo`` (it's numbered, with no unnumbered descendants)."""
+        return self.numbered and not db.session.query(self.unnumbered().exists()).scalar()
+
+    def subtree_filter(self, excludes: Optional[list[str]] = None, ranged: Optional[bool] = None):
+        """This row and its descendants: an integer range of ``lo``, if ``ranged`` (else ids from ``subtree_ids``)."""
+        if ranged is None:
+            ranged = self.ranged
+        if ranged:
+            filter = Node.lo.between(self.lo, self.hi)
+        else:
+            filter = Node.id.in_(subtree_ids([ self.id ]))
+        return filter & self.excludes_filter(excludes, ranged) if excludes else filter
+
+    def excludes_filter(self, excludes: list[str], ranged: bool):
+        """Rows outside ``excludes``' subtrees; numbered excludes (under a ``ranged`` row) are pruned by ``lo``."""
+        clauses = []
+        unnumbered = []
+        for row in resolve(excludes).values():
+            if ranged and row.lo is not None:
+                clauses.append(~Node.lo.between(row.lo, row.hi))
+            else:
+                unnumbered.append(row.id)
+        if unnumbered:
+            clauses.append(Node.id.not_in(subtree_ids(unnumbered)))
+        return and_(*clauses) if clauses else true()
+
+    def tree_rows(self, excludes: Optional[list[str]] = None):
+        """``(id, parent_id, name, kind, size, mtime, num_descendants)`` tuples for this node and its descendants, each
+        row's parent preceding it (cf. ``Tree.from_rows``): in pre-order if ``ranged``, else breadth-first."""
+        names = [ 'id', 'parent_id', 'name', 'kind', 'size', 'mtime', 'num_descendants' ]
+        if self.ranged:
+            cols = [ getattr(Node, name) for name in names ]
+            query = db.session.query(*cols).filter(self.subtree_filter(excludes, ranged=True)).order_by(Node.lo)
+        else:
+            excluded = [ row.id for row in resolve(excludes or []).values() ]
+            sub = subtree(self.id, self.path, filter=(lambda child: child.id.not_in(excluded)) if excluded else None)
+            query = db.session.query(*[ sub.c[name] for name in names ])
+        return query.yield_per(TREE_ROWS_BATCH_SIZE)
+
+
+# Per-directory lookups, prebuilt (so that executing them hits SQLAlchemy's compiled-statement cache cheaply)
+BY_KEYS = select(*Node.__table__.columns).where(tuple_(Node.parent_id, Node.name).in_(bindparam('keys', expanding=True)))
+BY_IDS = select(*Node.__table__.columns).where(Node.id.in_(bindparam('ids', expanding=True)))
+INSERT_PLACEHOLDERS = Node.__table__.insert().prefix_with('OR IGNORE')
+CHILD_PATH = bindparam('prefix', type_=String) + Node.name
+CHILDREN = (
+    select(*Node.__table__.columns, CHILD_PATH.label('path'))
+    .where((Node.parent_id == bindparam('id')) & CHILD_PATH.not_in(bindparam('excludes', expanding=True)))
+)
+
+
+class Checkpoint(db.Model):
+    """Directories whose scan (under ``root``) was in progress when a scan of ``root`` was checkpointed/interrupted."""
+    root = db.Column(db.String, primary_key=True)
+    path = db.Column(db.String, primary_key=True)
+    checked_at = db.Column(db.Integer, nullable=False)
 
     def __repr__(self):
-        return f'S3({self.bucket}/{self.path})'
+        return f'Checkpoint({self.root}: {self.path})'
+
+
+def legacy_ns(col, local=False):
+    """SQL converting ``col``, a ``DateTime`` written by an earlier version (stored by SQLAlchemy as ``YYYY-MM-DD
+    HH:MM:SS.ffffff`` text), to ns since the epoch; ``local`` times (``checked_at``s, from ``datetime.now()``, and
+    legacy ``s3`` rows' ``mtime``s) are converted from local time."""
+    secs = f"strftime('%s', {col}, 'utc')" if local else f"strftime('%s', {col})"
+    return (
+        f"CASE WHEN {col} = '1970-01-01 00:00:00.000000' THEN {EPOCH} "
+        f"ELSE CAST({secs} AS INTEGER) * 1000000000 + CAST(substr({col}, 21, 6) AS INTEGER) * 1000 END"
+    )
+
+
+# `PRAGMA user_version` of DBs whose timestamps are integers
+INT_TIMESTAMPS_VERSION = 1
+# Timestamp columns written as `DateTime`s by earlier versions, and whether they were local times
+TIMESTAMPS = dict(mtime=False, checked_at=True)
+
 
-    def descendants(self, excludes: Optional[list[str]] = None):
-        filter = S3.bucket == self.bucket
-        if self.key:
-            filter = filter & (
-                (S3.key == self.key) | (S3.parent == self.key) | S3.parent.startswith(f'{self.key}/')
+def migrate_legacy(batch_size=MIGRATE_BATCH_SIZE):
+    """Move rows from path-keyed ``file``/``s3`` tables (written by earlier versions, which stored each row's full
+    path and parent path) to ``node``, then drop them (and ``VACUUM``, to reclaim their space); ``DateTime`` timestamps
+    are converted to integers (once per DB)."""
+    from .bulk import BulkWriter
+    inspector = inspect(db.engine)
+    if db.session.execute(text('PRAGMA user_version')).scalar() < INT_TIMESTAMPS_VERSION:
+        for table in [ 'node', 'checkpoint' ]:
+            columns = { c['name'] for c in inspector.get_columns(table) } if inspector.has_table(table) else set()
+            for col, local in TIMESTAMPS.items():
+                if col in columns:
+                    db.session.execute(text(f"UPDATE {table} SET {col} = {legacy_ns(col, local)} WHERE typeof({col}) = 'text'"))
+        db.session.execute(text(f'PRAGMA user_version = {INT_TIMESTAMPS_VERSION}'))
+        db.session.commit()
+    # Legacy tables, their rows' paths, and whether their `mtime`s were local times (`s3`'s were `aws s3 ls`'s)
+    sources = [
+        ('file', 'path', False),
+        ('s3', f"'{S3_SCHEME}' || bucket || '/' || key", True),
+    ]
+    sources = [ source for source in sources if inspector.has_table(source[0]) ]
+    if not sources:
+        return
+    ids = {}
+    writer = BulkWriter(batch_size)
+    for table, path, local_mtimes in sources:
+        local = dict(TIMESTAMPS, mtime=local_mtimes)
+        columns = { c['name'] for c in inspector.get_columns(table) }
+        cols = [
+            c.name for c in Node.__table__.columns
+            if c.name in columns and c.name not in ('id', 'parent_id', 'name')
+        ]
+        exprs = [ f'{legacy_ns(col, local[col])} AS {col}' if col in local else col for col in cols ]
+        num_rows = db.session.execute(text(f'SELECT count(*) FROM {table}')).scalar()
+        if num_rows:
+            err(f'Migrating {num_rows} rows from `{table}` to `node`')
+        last = -1
+        while True:
+            query = text(
+                f'SELECT rowid, {path} AS path, {", ".join(exprs)} FROM {table} WHERE rowid > :last ORDER BY rowid LIMIT :n'
             )
-        if excludes:
-            filter = filter & S3.key.not_in(excludes) & S3.parent.not_in(excludes)
-            for exclude in excludes:
-                filter = filter & ~S3.parent.startswith(f'{exclude}/')
-        return self.query.filter(filter).all()
+            rows = db.session.execute(query, dict(last=last, n=batch_size)).all()
+            if not rows:
+                break
+            last = rows[-1].rowid
+            parents = { row.path: split(row.path) for row in rows }
+            resolve({ parent for parent, _ in parents.values() if parent is not None }, ids, create=True)
+            writer.extend(Node.__table__, [
+                dict(
+                    { c.name: None for c in Node.__table__.columns },
+                    parent_id=ROOT if parent is None else ids[parent],
+                    name=name,
+                    **{ col: getattr(row, col) for col in cols },
+                )
+                for row in rows
+                for parent, name in [ parents[row.path] ]
+            ])
+            writer.flush()
+    for table, *_ in sources:
+        db.session.execute(text(f'DROP TABLE {table}'))
+    db.session.commit()
+    with db.engine.connect() as conn:
+        conn.execute(text('VACUUM'))
@@ -1,9 +1,19 @@
 import re
-from os.path import join
 
-from utz import concat, DF, dirname, o, sxs, to_dt
+import numpy as np
+import pandas as pd
+from dateutil.tz import gettz
+from utz import DF, dirname, o, to_dt
+
+from .tree import KINDS, SEP, STR, Tree
 
 LINE_RGX = '(?P<mtime>\d{4}-\d{2}-\d{2} \d\d:\d\d:\d\d) +(?P<size>\d+) (?P<key>.*)'
+MTIME_FMT = '%Y-%m-%d %H:%M:%S'
+MTIME_WIDTH = len('YYYY-MM-DD HH:MM:SS')
+SPACE = np.array(' ', dtype=STR)
+
+# Characters of listing to parse at a time
+DEFAULT_BLOCK_SIZE = 1 << 24
 
 
 def parse_line(line):
@@ -17,6 +27,64 @@ def parse_line(line):
     return o(mtime=mtime, size=size, key=key)
 
 
+def parse_lines(lines):
+    """Vectorized ``parse_line``: slice off each line's fixed-width mtime, then split the (space-padded) size from the
+    key. Returns a DataFrame with ``mtime``, ``size`` and ``key`` columns (mtimes as written: UTC, in ``format_lines``'
+    output, but local times in ``aws s3 ls``')."""
+    lines = np.asarray(lines, dtype=STR)
+    mtimes = np.strings.slice(lines, 0, MTIME_WIDTH)
+    sizes, seps, keys = np.strings.partition(np.strings.lstrip(np.strings.slice(lines, MTIME_WIDTH, None), SPACE), SPACE)
+    valid = (np.strings.slice(lines, MTIME_WIDTH, MTIME_WIDTH + 1) == ' ') & (seps == ' ') & np.strings.isdecimal(sizes)
+    if not valid.all():
+        # Raises, with the first bad line
+        parse_line(str(lines[~valid][0]))
+    return DF({
+        'mtime': pd.to_datetime(mtimes.astype(object), format=MTIME_FMT).astype('datetime64[ns]'),
+        'size': sizes.astype(np.int64),
+        'key': keys.astype(object),
+    })
+
+
+def utc_mtimes(mtimes):
+    """UTC timestamps (``datetime``s or ISO 8601 strings) as listings store them: naive UTC times, truncated to
+    seconds."""
+    mtimes = pd.to_datetime(pd.Series(mtimes), utc=True, format='ISO8601')
+    return mtimes.dt.tz_localize(None).dt.floor('s').astype('datetime64[ns]')
+
+
+def local_to_utc(mtimes):
+    """Naive local times (as ``aws s3 ls`` shows them) as naive UTC times; ambiguous ones (repeated when DST ends) are
+    taken to be in standard time (``gettz()``, unlike ``tzlocal()``, tells them apart)."""
+    mtimes = pd.Series(mtimes).dt.tz_localize(gettz(), ambiguous=np.zeros(len(mtimes), dtype=bool), nonexistent='shift_forward')
+    return mtimes.dt.tz_convert('UTC').dt.tz_localize(None).astype('datetime64[ns]')
+
+
+def format_lines(files):
+    """Inverse of ``parse_lines``: ``aws s3 ls --recursive``-style lines (but with UTC mtimes) for a DataFrame of
+    ``mtime``s, ``size``s and ``key``s."""
+    mtimes = files['mtime'].dt.strftime(MTIME_FMT).to_numpy(dtype=STR)
+    sizes = np.strings.rjust(files['size'].to_numpy().astype(STR), 10)
+    keys = files['key'].to_numpy(dtype=STR)
+    return np.strings.add(np.strings.add(np.strings.add(np.strings.add(mtimes, SPACE), sizes), SPACE), keys).tolist()
+
+
+def read_listing(path, block_size=DEFAULT_BLOCK_SIZE):
+    """Parse the ``aws s3 ls --recursive``-style listing at ``path`` ``block_size`` characters at a time, yielding one
+    ``parse_lines`` DataFrame per block (so memory use is bounded by ``block_size``, not the size of the listing)."""
+    with open(path, 'r') as f:
+        rest = ''
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            lines = (rest + block).split('\n')
+            rest = lines.pop()
+            if lines:
+                yield parse_lines(lines)
+        if rest:
+            yield parse_lines([ rest ])
+
+
 def dirs(file):
     #rv = [file]
     rv = []
@@ -31,47 +99,86 @@ def dirs(file):
     return list(reversed(rv))
 
 
-def flatmap(self, func):
-    dfs = []
-    for idx, row in self.iterrows():
-        df = func(row)
-        dfs.append(df)
-    return concat(dfs)
-
-
-DF.flatmap = flatmap
-
-
-def expand_file_row(r):
-    file_df = r.to_frame().transpose()
-    if r.key.endswith('/'):
-        return DF()
-    ancestors = dirs(r.relpath)
-    dirs_df = DF([
-        {
-            **r.to_dict(),
-            # mtime=r.mtime,
-            # size=r['size'],
-            'key': join(r.root_key, dir) if dir else r.root_key,
-            'kind': 'dir',
-        }
-        for dir in ancestors
-    ])
-    rows = concat([file_df, dirs_df]).reset_index(drop=True)
-    return rows
-
-
 def agg_dirs(files, k='key'):
-    files['kind'] = 'file'
-    expanded = files.flatmap(expand_file_row)
-    groups = expanded.groupby([k, 'kind'])
-    if len(groups) == len(files):
-        return files
-    sizes = groups['size'].sum()
-    mtimes = groups['mtime'].max()
-    num_descendants = groups.size().rename('num_descendants')
-    aggd = sxs(mtimes, sizes, num_descendants).reset_index()
-    return aggd
+    """Aggregate ``files`` (with ``relpath``, ``size``, ``mtime`` and ``root_key`` columns) into rows for each file and
+    each directory containing them (keyed by ``root_key``-prefixed paths), with ``kind``, total ``size``, max
+    ``mtime`` (ns since the epoch), and ``num_descendants`` (files) columns; no rows (not even ``root_key``'s) for no
+    ``files``."""
+    if files.empty:
+        return DF({ k: [], 'kind': [], 'size': [], 'mtime': [], 'num_descendants': [] })
+    root_key = files['root_key'].iloc[0]
+    mtimes = files['mtime'].astype('datetime64[ns]').astype('int64')
+    tree = Tree.from_keys(root_key, files['relpath'], files['size'], mtimes)
+    # `from_keys` puts directories first, followed by files (in input order, so their keys can be reused)
+    num_dirs = len(tree) - len(files)
+    return DF({
+        k: np.concatenate([ tree.all_paths(num_dirs), files[k].to_numpy(dtype=object) ]),
+        'kind': np.array(KINDS)[tree.kind],
+        'size': tree.size,
+        'mtime': tree.mtime,
+        'num_descendants': tree.num_descendants,
+    })
+
+
+def filter_prefix(listing, prefix):
+    """Restrict blocks of a (``read_listing``) listing to keys under ``prefix`` (dropping blocks with none)."""
+    for files in listing:
+        files = files[files.key.str.startswith(prefix)]
+        if not files.empty:
+            yield files
+
+
+class DirTotals:
+    """Directory rows (as returned by ``agg_dirs``) summed across blocks of a listing.
+
+    Each block's partial totals are buffered, and merged (in one vectorized ``groupby``) once they outnumber the
+    already-merged rows, so memory stays proportional to the number of directories, and each partial row is merged
+    O(1) times (amortized).
+    """
+    def __init__(self, k='key'):
+        self.k = k
+        self.parts = []
+        self.num_merged = 0
+        self.num_pending = 0
+
+    def add(self, dirs):
+        self.parts.append(dirs)
+        self.num_pending += len(dirs)
+        if self.num_pending > self.num_merged:
+            self.merge()
+
+    def merge(self):
+        if not self.parts:
+            return
+        dirs = pd.concat(self.parts, ignore_index=True)
+        dirs = dirs.groupby([ self.k, 'kind' ], sort=False, as_index=False).agg(
+            size=('size', 'sum'),
+            mtime=('mtime', 'max'),
+            num_descendants=('num_descendants', 'sum'),
+        )
+        self.parts = [ dirs ]
+        self.num_merged = len(dirs)
+        self.num_pending = 0
+
+    def total(self):
+        self.merge()
+        return self.parts[0] if self.parts else None
+
+
+def strip_prefixes(keys, prefix):
+    """Vectorized ``strip_prefix``, over a Series of keys."""
+    if not prefix:
+        return keys
+    keys = keys.to_numpy(dtype=STR)
+    matches = np.strings.startswith(keys, prefix)
+    if not matches.all():
+        strip_prefix(str(keys[~matches][0]), prefix)
+    return np.strings.slice(keys, len(prefix), None).astype(object)
+
+
+def parents(keys):
+    """Vectorized ``dirname``, over a Series of ``/``-delimited keys."""
+    return np.strings.rpartition(keys.to_numpy(dtype=STR), SEP)[0].astype(object)
 
 
 def strip_prefix(key, prefix):
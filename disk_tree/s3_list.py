@@ -0,0 +1,257 @@
+from concurrent.futures import ThreadPoolExecutor
+from os.path import exists, join
+from queue import Full, Queue
+from shutil import rmtree
+from threading import Event
+
+import boto3
+import json
+import os
+import pandas as pd
+from bisect import bisect_right
+from time import perf_counter
+from utz import DF, err
+
+from . import listing_cache, s3
+
+# Threads listing shards concurrently, and shards to split a listing into per thread
+DEFAULT_JOBS = 8
+SHARDS_PER_JOB = 4
+PAGE_SIZE = 1000
+# Keys to accumulate before handing a block of pages to the ingest pipeline
+BLOCK_SIZE = 100_000
+# Seconds between saves of an in-progress listing's shard tokens
+SAVE_INTERVAL = 1
+
+
+def plan_shards(client, bucket, prefix, num_shards, pool):
+    """Split the keys under ``prefix`` into (up to) ``num_shards`` ``(start_after, end]`` ranges.
+
+    Range boundaries are "directories" (common prefixes) found by delimiter listings, one level at a time until there
+    are enough of them (only each listing's first page is needed); ``None`` bounds are open."""
+    boundaries = []
+    level = [ prefix ]
+    while level and len(boundaries) + 1 < num_shards:
+        responses = pool.map(lambda p: client.list_objects_v2(Bucket=bucket, Prefix=p, Delimiter='/'), level)
+        level = [ cp['Prefix'] for r in responses for cp in r.get('CommonPrefixes', []) ]
+        boundaries += level
+    boundaries = sorted(boundaries)
+    if len(boundaries) >= num_shards:
+        boundaries = [ boundaries[i * len(boundaries) // num_shards] for i in range(1, num_shards) ]
+    return list(zip([ None ] + boundaries, boundaries + [ None ]))
+
+
+def list_shard(client, bucket, prefix, shard, token=None):
+    """Yield ``(contents, token)`` for each page of keys under ``prefix`` in ``shard`` (a ``(start_after, end]`` range),
+    where ``token`` continues the listing after that page (``None`` after the last one)."""
+    start_after, end = shard
+    kwargs = dict(Bucket=bucket, Prefix=prefix, MaxKeys=PAGE_SIZE)
+    if start_after is not None:
+        kwargs['StartAfter'] = start_after
+    while True:
+        response = client.list_objects_v2(**kwargs, **(dict(ContinuationToken=token) if token else {}))
+        contents = response.get('Contents', [])
+        token = response.get('NextContinuationToken') if response['IsTruncated'] else None
+        if end is not None and contents and contents[-1]['Key'] > end:
+            # S3 lists keys in (UTF-8 byte, i.e. code point) order, so the rest of the listing is past `end`
+            contents = contents[:bisect_right([ obj['Key'] for obj in contents ], end)]
+            token = None
+        yield contents, token
+        if token is None:
+            break
+
+
+def page_df(contents):
+    """``s3.parse_lines``-style DataFrame (``mtime``, ``size``, ``key``) of a page of ListObjectsV2 ``Contents``.
+
+    Its mtimes are naive UTC times, truncated to seconds (``s3.utc_mtimes``)."""
+    return DF({
+        'mtime': s3.utc_mtimes([ obj['LastModified'] for obj in contents ]),
+        'size': pd.array([ obj['Size'] for obj in contents ], dtype='int64'),
+        'key': pd.array([ obj['Key'] for obj in contents ], dtype=object),
+    })
+
+
+class Lister:
+    """Native (``boto3``) ListObjectsV2 listing of the keys under a prefix, split into key-range shards that are listed
+    concurrently on a thread pool.
+
+    ``shards`` are dicts with ``start_after``/``end`` bounds, a ``token`` to continue from, and whether they're
+    ``done`` (default: planned by ``plan_shards``). Iterating yields ``(shard index, contents, token)`` for each page as
+    it arrives (``token`` continues the shard's listing after that page, and is ``None`` after its last one); worker
+    threads block on a bounded queue, so a slow consumer bounds the number of pages in memory.
+    """
+    def __init__(self, bucket, prefix, jobs=None, num_shards=None, client=None, shards=None):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.jobs = jobs or DEFAULT_JOBS
+        self.num_shards = num_shards or self.jobs * SHARDS_PER_JOB
+        self.client = client or boto3.client('s3')
+        self.shards = shards
+        self.stopped = Event()
+
+    def put(self, queue, item):
+        while not self.stopped.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return
+            except Full:
+                pass
+
+    def run(self, i, pages):
+        shard = self.shards[i]
+        try:
+            for contents, token in list_shard(self.client, self.bucket, self.prefix, (shard['start_after'], shard['end']), shard['token']):
+                self.put(pages, (i, contents, token, None))
+                if self.stopped.is_set():
+                    return
+        except Exception as e:
+            self.put(pages, (i, None, None, e))
+
+    def __iter__(self):
+        with ThreadPoolExecutor(self.jobs) as pool:
+            if self.shards is None:
+                self.shards = [
+                    dict(start_after=start_after, end=end, token=None, done=False)
+                    for start_after, end in plan_shards(self.client, self.bucket, self.prefix, self.num_shards, pool)
+                ]
+            todo = [ i for i, shard in enumerate(self.shards) if not shard['done'] ]
+            err(f'Listing s3://{self.bucket}/{self.prefix} in {len(todo)} shards, {self.jobs} at a time')
+            pages = Queue(maxsize=4 * self.jobs)
+            for i in todo:
+                pool.submit(self.run, i, pages)
+            remaining = len(todo)
+            try:
+                while remaining:
+                    i, contents, token, exc = pages.get()
+                    if exc is not None:
+                        raise exc
+                    if token is None:
+                        remaining -= 1
+                    yield i, contents, token
+            finally:
+                self.stopped.set()
+
+
+class ShardedListing:
+    """Listing of the keys under a prefix into a listing cache at ``path``, that can resume after being interrupted.
+
+    While in progress, each shard's lines (in ``aws s3 ls --recursive`` format, with UTC mtimes) are appended to
+    ``<path>.shards/<i>.txt``, and the shards' ranges, continuation tokens, and lines-file lengths as of those tokens
+    are saved to ``<path>.shards/shards.json`` (every ``save_interval`` seconds, and when interrupted). A later listing
+    of the same ``path`` truncates the shards' lines to the saved lengths, (re-)yields them, and continues each
+    unfinished shard from its token; lines without saved shards (from a listing killed before its first save) are
+    discarded. Once every shard is done, their lines are written (in key order) to the binary listing cache at ``path``
+    (see ``listing_cache``).
+    """
+    def __init__(self, path, bucket, prefix, jobs=None, client=None, save_interval=SAVE_INTERVAL):
+        self.path = path
+        self.dir = f'{path}.shards'
+        self.state_path = join(self.dir, 'shards.json')
+        self.bucket = bucket
+        self.prefix = prefix
+        self.jobs = jobs
+        self.client = client
+        self.save_interval = save_interval
+        self.started = None
+        self.lister = None
+        self.files = {}
+
+    def shard_path(self, i):
+        return join(self.dir, f'{i}.txt')
+
+    def load(self):
+        """Saved shards of an interrupted listing (or ``None``)."""
+        if not exists(self.state_path):
+            return None
+        with open(self.state_path, 'r') as f:
+            state = json.load(f)
+        self.started = pd.Timestamp(state['started'])
+        return state['shards']
+
+    def age(self):
+        """Time since the saved listing (if any) started."""
+        return pd.Timestamp.now() - self.started if self.load() is not None else None
+
+    def discard(self):
+        if exists(self.dir):
+            rmtree(self.dir)
+
+    def save(self):
+        shards = self.lister.shards if self.lister else None
+        if shards is None:
+            return
+        for f in self.files.values():
+            f.flush()
+        tmp_path = f'{self.state_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(dict(started=self.started.isoformat(), shards=shards), f)
+        os.replace(tmp_path, self.state_path)
+
+    def resumed(self, shards, block_size):
+        num_done = sum(shard['done'] for shard in shards)
+        err(f'Resuming interrupted listing of s3://{self.bucket}/{self.prefix} ({num_done}/{len(shards)} shards done)')
+        for i, shard in enumerate(shards):
+            shard_path = self.shard_path(i)
+            if not exists(shard_path):
+                continue
+            # Drop any lines written after the last saved token
+            os.truncate(shard_path, shard.get('offset', 0))
+            yield from s3.read_listing(shard_path, block_size)
+
+    def blocks(self, block_size=s3.DEFAULT_BLOCK_SIZE, num_keys=BLOCK_SIZE):
+        """Yield ``s3.parse_lines``-style DataFrames of (about) ``num_keys`` keys at a time."""
+        shards = self.load()
+        if shards is None:
+            # Lines written by a listing that was killed before it first saved its shards can't be resumed
+            self.discard()
+            self.started = pd.Timestamp.now()
+        os.makedirs(self.dir, exist_ok=True)
+        if shards is not None:
+            yield from self.resumed(shards, block_size)
+        self.lister = Lister(self.bucket, self.prefix, jobs=self.jobs, client=self.client, shards=shards)
+        last_save = perf_counter()
+        block = []
+        block_keys = 0
+        try:
+            for i, contents, token in self.lister:
+                shard = self.lister.shards[i]
+                if contents:
+                    f = self.files.get(i)
+                    if f is None:
+                        f = self.files[i] = open(self.shard_path(i), 'a')
+                    files = page_df(contents)
+                    f.write('\n'.join(s3.format_lines(files)))
+                    f.write('\n')
+                    block.append(files)
+                    block_keys += len(files)
+                shard['token'] = token
+                shard['done'] = token is None
+                shard['offset'] = self.files[i].tell() if i in self.files else shard.get('offset', 0)
+                if perf_counter() - last_save >= self.save_interval:
+                    self.save()
+                    last_save = perf_counter()
+                if block_keys >= num_keys:
+                    yield pd.concat(block, ignore_index=True)
+                    block = []
+                    block_keys = 0
+        except BaseException:
+            self.save()
+            raise
+        finally:
+            for f in self.files.values():
+                f.close()
+            self.files = {}
+        if block:
+            yield pd.concat(block, ignore_index=True)
+        self.finish()
+
+    def finish(self):
+        shard_paths = [ self.shard_path(i) for i in range(len(self.lister.shards)) ]
+        listing_cache.write(self.path, (
+            files
+            for shard_path in shard_paths
+            if exists(shard_path)
+            for files in s3.read_listing(shard_path)
+        ))
+        self.discard()
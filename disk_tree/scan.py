@@ -0,0 +1,357 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from stat import S_ISDIR, S_ISREG
+
+import numpy as np
+import os
+from os.path import basename
+from time import perf_counter
+from utz import err
+
+from .tree import DIR, FILE, Tree
+
+DEFAULT_CHECKPOINT_INTERVAL = 60
+
+
+def is_descendant(path, ancestor):
+    path = path.rstrip('/').split('/')
+    ancestor = ancestor.rstrip('/').split('/')
+    if len(path) < len(ancestor):
+        return False
+    for (l, r) in zip(path, ancestor):
+        if l != r:
+            return False
+    return True
+
+
+def timed_stat(stats, stat, *args, **kwargs):
+    if stats is None:
+        return stat(*args, **kwargs)
+    start = perf_counter()
+    rv = stat(*args, **kwargs)
+    stats.record_stat(perf_counter() - start)
+    return rv
+
+
+def list_dir(path, excludes=None, stats=None):
+    """List and stat the children of ``path``, with one ``lstat`` per child.
+
+    Entries are classified from ``os.scandir``'s d_type, and each child's stat comes from its ``DirEntry`` (subdirectory
+    stats are passed down to their own listings, so every inode is stat'd exactly once). Runs on scanner worker
+    threads, so it only touches the filesystem (no DB / ORM access).
+    """
+    names = set()
+    file_stats = []
+    subdir_stats = []
+    # Entries are handled as they're read, rather than materializing the listing (whose size is unbounded); only time
+    # spent in `scandir` itself (opening the directory, and reading each entry) counts toward its latency
+    elapsed = 0.
+    start = perf_counter()
+    try:
+        it = os.scandir(path)
+    except OSError as e:
+        err(f'Error traversing {path}: {e}')
+        return None
+    with it:
+        while True:
+            try:
+                entry = next(it, None)
+            except OSError as e:
+                err(f'Error traversing {path}: {e}')
+                return None
+            elapsed += perf_counter() - start
+            if entry is None:
+                break
+            names.add(entry.name)
+            child = entry.path
+            if excludes and any(is_descendant(child, exclude) for exclude in excludes):
+                err(f'skipping excluded: {child}')
+            elif entry.is_symlink():
+                err(f'Skipping symlink: {child}')
+            elif entry.is_file(follow_symlinks=False):
+                file_stats.append((child, timed_stat(stats, entry.stat, follow_symlinks=False)))
+            elif entry.is_dir(follow_symlinks=False):
+                subdir_stats.append((child, timed_stat(stats, entry.stat, follow_symlinks=False)))
+            else:
+                err(f'Skipping special file: {child}')
+            start = perf_counter()
+    if stats is not None:
+        stats.record_scandir(elapsed)
+    return names, file_stats, subdir_stats
+
+
+def is_unchanged_dir(stat, cached):
+    """Whether a directory's entries can't have changed since ``cached`` was written.
+
+    Adding, removing, or renaming an entry bumps the directory's mtime and ctime."""
+    return (
+        cached is not None and
+        cached.st_mtime_ns == stat.st_mtime_ns and
+        cached.st_ctime_ns == stat.st_ctime_ns
+    )
+
+
+def stat_children(path, db_children, excludes=None, stats=None):
+    """Re-stat the cached children of an unchanged directory, in lieu of listing it.
+
+    Returns ``None`` (so the caller falls back to ``list_dir``) if any child has disappeared or changed type.
+    """
+    file_stats = []
+    subdir_stats = []
+    for c in db_children:
+        child = c.path
+        if excludes and any(is_descendant(child, exclude) for exclude in excludes):
+            continue
+        try:
+            stat = timed_stat(stats, os.lstat, child)
+        except FileNotFoundError:
+            return None
+        if c.kind == 'file' and S_ISREG(stat.st_mode):
+            file_stats.append((child, stat))
+        elif c.kind == 'dir' and S_ISDIR(stat.st_mode):
+            subdir_stats.append((child, stat))
+        else:
+            return None
+    return None, file_stats, subdir_stats
+
+
+def rescan_dir(path, stat, cached, db_children, excludes=None, stats=None):
+    listing = None
+    if is_unchanged_dir(stat, cached):
+        listing = stat_children(path, db_children, excludes, stats)
+    return listing or list_dir(path, excludes, stats)
+
+
+class Task:
+    def __init__(self, path, stat, cached, db_children, parent):
+        self.path = path
+        self.stat = stat
+        self.cached = cached
+        self.db_children = db_children
+        self.parent = parent
+
+    def run(self, excludes=None, stats=None):
+        start = perf_counter()
+        listing = rescan_dir(self.path, self.stat, self.cached, self.db_children, excludes, stats)
+        if stats is not None and listing is not None:
+            _, file_stats, subdir_stats = listing
+            stats.record_dir(self.path, perf_counter() - start, len(file_stats) + len(subdir_stats))
+        return listing
+
+
+class Dir:
+    def __init__(self, task, names, node):
+        self.task = task
+        self.names = names
+        self.node = node
+        self.pending = 0
+        # Tree nodes of this directory's children: a range (its files, and reused fresh subdirectories, added as it's
+        # visited), and those of scanned subdirectories (added as they're visited)
+        self.children = None
+        self.subdirs = []
+
+    def child_nodes(self):
+        return np.concatenate([ np.arange(*self.children), self.subdirs ]).astype(np.int64)
+
+
+class Scanner:
+    """Post-order directory-tree traversal, driven by an explicit stack (or, with ``jobs > 1``, a thread pool).
+
+    Listing and stat'ing happens in ``Task.run`` (on worker threads, in the parallel case); the calling thread builds
+    the ``Node`` rows, so all DB access stays on one thread. Every entry also gets a node in ``self.tree``. Once all of
+    a directory's subdirectories have completed, its ``Dir`` is released, and it is queued to have its totals
+    aggregated (in vectorized batches, by ``Tree.aggregate``) and its row inserted.
+
+    Completed rows and that frontier are checkpointed to the cache every ``checkpoint_interval`` seconds, and when the
+    scan is interrupted. Subdirectories whose rows were completed within the cache TTL (before an interrupted scan of
+    the same root, or by a scan of the subdirectory itself) aren't rescanned; their cached totals are used instead.
+    """
+    def __init__(self, cache, jobs=None, now=None, excludes=None, one_file_system=False, checkpoint_interval=None):
+        self.cache = cache
+        self.jobs = jobs
+        self.now = now
+        self.excludes = excludes
+        self.one_file_system = one_file_system
+        self.checkpoint_interval = checkpoint_interval
+        self.stats = cache.stats
+        self.dev = None
+        self.skipped_mounts = []
+        self.root = None
+        self.resume = False
+        self.fresh = {}
+        self.incomplete = set()
+        self.last_checkpoint = None
+        self.tree = Tree()
+        self.completed = []
+        self.root_row = None
+
+    def start(self, path, stat, cached):
+        self.root = path
+        if self.one_file_system:
+            self.dev = stat.st_dev
+        frontier = self.cache.checkpoint_frontier(path)
+        if frontier:
+            err(f'Resuming interrupted scan of {path} ({len(frontier)} directories were in progress)')
+            self.resume = True
+        self.fresh = self.cache.fresh_subdirs(path)
+        if self.fresh:
+            err(f'Reusing {len(self.fresh)} subdirectories of {path} cached within the TTL')
+        self.last_checkpoint = perf_counter()
+        return self.task(path, stat, cached, None)
+
+    def task(self, path, stat, cached, parent):
+        self.incomplete.add(path)
+        # Cached children are read on the calling thread; tasks (and worker threads) get plain rows
+        db_children = self.cache.db_children(path, self.excludes) if self.cache.incremental else None
+        return Task(path, stat, cached, db_children, parent)
+
+    def checkpoint(self):
+        self.flush_dirs()
+        self.cache.checkpoint(self.root, self.incomplete, now=self.now)
+        self.last_checkpoint = perf_counter()
+
+    def checkpoint_interrupted(self):
+        if self.root is not None:
+            err(f'Checkpointing interrupted scan of {self.root} ({len(self.incomplete)} directories in progress)')
+            self.checkpoint()
+
+    @contextmanager
+    def checkpointing(self):
+        try:
+            yield
+        except BaseException:
+            self.checkpoint_interrupted()
+            raise
+
+    def scan(self, path, stat, cached=None):
+        task = self.start(path, stat, cached)
+        if self.jobs and self.jobs > 1:
+            return self.scan_parallel(task)
+        root = None
+        stack = [ task ]
+        with self.checkpointing():
+            while stack:
+                task = stack.pop()
+                file = self.visit(task, task.run(self.excludes, self.stats), stack.append)
+                if file is not None:
+                    root = file
+        return root
+
+    def scan_parallel(self, task):
+        root = None
+        with self.checkpointing(), ThreadPoolExecutor(self.jobs) as pool:
+            futures = {}
+
+            def submit(task):
+                futures[pool.submit(task.run, self.excludes, self.stats)] = task
+
+            submit(task)
+            try:
+                while futures:
+                    done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        task = futures.pop(future)
+                        file = self.visit(task, future.result(), submit)
+                        if file is not None:
+                            root = file
+            except BaseException:
+                pool.shutdown(wait=False, cancel_futures=True)
+                raise
+        return root
+
+    def visit(self, task, listing, submit):
+        """Insert rows for ``task``'s files, ``submit`` tasks for its subdirectories, and insert rows for any
+        directories that this completes. Returns the root directory's row, once it completes."""
+        cache = self.cache
+        parent = task.parent
+        if listing is None:
+            d = None
+            self.incomplete.discard(task.path)
+        else:
+            names, file_stats, subdir_stats = listing
+            cached_children = { c.path: c for c in task.db_children or [] }
+            # Only incremental scans compare fresh stats against (and skip rewriting) cached rows
+            unchanged_candidates = cached_children if cache.incremental else {}
+            tree = self.tree
+            node = tree.add(
+                -1 if parent is None else parent.node,
+                task.path if parent is None else basename(task.path),
+                DIR,
+                mtime=task.stat.st_mtime_ns,
+            )
+            if parent is not None:
+                parent.subdirs.append(node)
+            d = Dir(task, names, node)
+            subdirs = []
+            for child, child_stat in file_stats:
+                mtime = cache.insert_file(child, child_stat, now=self.now, cached=unchanged_candidates.get(child))
+                tree.add(node, basename(child), FILE, child_stat.st_size, mtime, 1)
+            for subdir, subdir_stat in subdir_stats:
+                if self.dev is not None and subdir_stat.st_dev != self.dev:
+                    err(f'Skipping mountpoint: {subdir}')
+                    self.skipped_mounts.append(subdir)
+                    cache.expire_cached(subdir)
+                    continue
+                fresh = self.fresh.get(subdir)
+                if fresh is not None:
+                    # Completed before this scan was interrupted, or scanned on its own more recently than its parent
+                    tree.add(node, basename(subdir), DIR, fresh.size, fresh.mtime, fresh.num_descendants)
+                    continue
+                submit(self.task(subdir, subdir_stat, unchanged_candidates.get(subdir), d))
+                d.pending += 1
+                subdirs.append(subdir)
+            d.children = (node + 1, len(tree))
+            # Subdirectories' nodes, for their children's rows to reference (placeholders, until their own rows are
+            # written), created in one batch
+            cache.node_ids(subdirs, create=True)
+            if d.pending:
+                self.maybe_checkpoint()
+                return None
+        while True:
+            if d is not None:
+                t = d.task
+                if d.names is not None:
+                    cache.expire_stale(t.path, d.names, excludes=self.excludes, db_children=t.db_children)
+                self.completed.append((d.node, d.child_nodes(), t.path, t.stat, t.cached))
+                self.incomplete.discard(t.path)
+                if parent is None:
+                    self.flush_dirs()
+                    return self.root_row
+                if len(self.completed) >= cache.writer.batch_size:
+                    self.flush_dirs()
+            elif parent is None:
+                return None
+            parent.pending -= 1
+            if parent.pending:
+                self.maybe_checkpoint()
+                return None
+            d, parent = parent, parent.task.parent
+
+    def flush_dirs(self):
+        """Aggregate completed directories' totals (vectorized, over their children in ``self.tree``), and insert their
+        rows."""
+        completed = self.completed
+        if not completed:
+            return
+        tree = self.tree
+        tree.aggregate(
+            [ node for node, *_ in completed ],
+            np.concatenate([ children for _, children, *_ in completed ]),
+        )
+        size, mtime, num_descendants = tree.size, tree.mtime, tree.num_descendants
+        for node, _, path, stat, cached in completed:
+            row = self.cache.insert_dir(
+                path, stat,
+                size=int(size[node]),
+                mtime=int(mtime[node]),
+                num_descendants=int(num_descendants[node]),
+                now=self.now,
+                cached=cached,
+            )
+            if node == 0:
+                self.root_row = row
+        self.completed = []
+
+    def maybe_checkpoint(self):
+        if self.checkpoint_interval and perf_counter() - self.last_checkpoint >= self.checkpoint_interval:
+            self.checkpoint()
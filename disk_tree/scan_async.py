@@ -0,0 +1,91 @@
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from .scan import Scanner, is_descendant
+
+DEFAULT_CONCURRENCY = 64
+
+
+def in_thread(executor, fn, *args, **kwargs):
+    """Run ``fn`` on ``executor`` from the running event loop (in a copy of the current context, so that it sees the
+    Flask app context, and so the DB session); returns an awaitable."""
+    context = contextvars.copy_context()
+    return asyncio.get_running_loop().run_in_executor(executor, partial(context.run, fn, *args, **kwargs))
+
+
+class AsyncScanner(Scanner):
+    """``Scanner`` driven by an asyncio event loop, for high-latency (network) filesystems.
+
+    Each directory's ``Task.run`` (scandir + stats) is offloaded to a thread pool, with up to ``concurrency`` in flight
+    at once; ``mount_concurrency`` maps mountpoints to their own limits (the deepest mountpoint containing a directory
+    applies). All DB access (reading cached rows, building and inserting rows, checkpoints) happens on ``db_executor``,
+    a single "writer" thread, one call at a time, so the event loop is never blocked on SQLite.
+    """
+    def __init__(
+            self,
+            cache,
+            db_executor,
+            concurrency=None,
+            mount_concurrency=None,
+            now=None,
+            excludes=None,
+            one_file_system=False,
+            checkpoint_interval=None,
+    ):
+        super().__init__(
+            cache,
+            now=now,
+            excludes=excludes,
+            one_file_system=one_file_system,
+            checkpoint_interval=checkpoint_interval,
+        )
+        self.db_executor = db_executor
+        self.concurrency = concurrency or DEFAULT_CONCURRENCY
+        self.mount_concurrency = mount_concurrency or {}
+        self.semaphore = asyncio.BoundedSemaphore(self.concurrency)
+        self.mount_semaphores = {
+            mount.rstrip('/') or '/': asyncio.BoundedSemaphore(n)
+            for mount, n in self.mount_concurrency.items()
+        }
+
+    def semaphore_for(self, path):
+        mounts = [ mount for mount in self.mount_semaphores if is_descendant(path, mount) ]
+        if mounts:
+            return self.mount_semaphores[max(mounts, key=len)]
+        return self.semaphore
+
+    async def run(self, task, executor):
+        async with self.semaphore_for(task.path):
+            listing = await asyncio.get_running_loop().run_in_executor(executor, task.run, self.excludes, self.stats)
+        return task, listing
+
+    async def scan(self, path, stat, cached=None):
+        root = None
+        max_workers = self.concurrency + sum(self.mount_concurrency.values())
+        db = partial(in_thread, self.db_executor)
+        with ThreadPoolExecutor(max_workers) as executor:
+            pending = set()
+            # Tasks for subdirectories, queued by `visit` (on the DB thread), and submitted from the event loop
+            tasks = []
+            try:
+                tasks.append(await db(self.start, path, stat, cached))
+                while tasks or pending:
+                    for task in tasks:
+                        pending.add(asyncio.ensure_future(self.run(task, executor)))
+                    tasks = []
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for future in done:
+                        task, listing = future.result()
+                        file = await db(self.visit, task, listing, tasks.append)
+                        if file is not None:
+                            root = file
+            except BaseException:
+                for future in pending:
+                    future.cancel()
+                executor.shutdown(wait=False, cancel_futures=True)
+                # Queued behind any in-flight `visit`, on the DB thread
+                await db(self.checkpoint_interrupted)
+                raise
+        return root
@@ -0,0 +1,156 @@
+import heapq
+import json
+from contextlib import contextmanager, nullcontext
+from threading import Lock
+from time import perf_counter
+from utz import err
+
+
+class Histogram:
+    """Latency counts in power-of-2 microsecond buckets: bucket 0 is <1µs, bucket ``i`` is [2^(i-1), 2^i) µs."""
+    def __init__(self):
+        self.counts = []
+        self.total = 0
+        self.max = 0
+
+    def add(self, elapsed):
+        bucket = int(elapsed * 1e6).bit_length()
+        if bucket >= len(self.counts):
+            self.counts += [0] * (bucket + 1 - len(self.counts))
+        self.counts[bucket] += 1
+        self.total += elapsed
+        self.max = max(self.max, elapsed)
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    @staticmethod
+    def bucket_label(bucket):
+        return '<1µs' if bucket == 0 else f'<{2 ** bucket}µs'
+
+    def quantile(self, q):
+        """Upper bound (in µs) of the bucket containing the ``q``-th quantile (capped at the observed max)."""
+        target = q * self.count
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= target:
+                return min(2 ** bucket, round(self.max * 1e6))
+        return None
+
+    def to_dict(self):
+        count = self.count
+        return dict(
+            count=count,
+            mean_us=self.total / count * 1e6 if count else None,
+            max_us=self.max * 1e6,
+            p50_us=self.quantile(.5),
+            p90_us=self.quantile(.9),
+            p99_us=self.quantile(.99),
+            buckets={ self.bucket_label(bucket): count for bucket, count in enumerate(self.counts) if count },
+        )
+
+
+class ScanStats:
+    """Throughput and latency measurements for a scan.
+
+    ``record_*`` methods may be called from scanner worker threads.
+    """
+    def __init__(self, top=10):
+        self.top = top
+        self.lock = Lock()
+        self.started = None
+        self.elapsed = 0
+        self.dirs = 0
+        self.entries = 0
+        self.stat = Histogram()
+        self.scandir = Histogram()
+        self.fs_time = 0
+        self.db_write_time = 0
+        self.db_read_time = 0
+        self.rows_written = 0
+        self.slowest = []
+
+    def start(self):
+        self.started = perf_counter()
+
+    def stop(self):
+        if self.started is not None:
+            self.elapsed += perf_counter() - self.started
+            self.started = None
+
+    def record_stat(self, elapsed):
+        with self.lock:
+            self.stat.add(elapsed)
+
+    def record_scandir(self, elapsed):
+        with self.lock:
+            self.scandir.add(elapsed)
+
+    def record_dir(self, path, elapsed, entries):
+        with self.lock:
+            self.dirs += 1
+            self.entries += entries
+            self.fs_time += elapsed
+            item = (elapsed, path, entries)
+            if len(self.slowest) < self.top:
+                heapq.heappush(self.slowest, item)
+            else:
+                heapq.heappushpop(self.slowest, item)
+
+    def record_rows(self, num_rows):
+        with self.lock:
+            self.rows_written += num_rows
+
+    @contextmanager
+    def timer(self, attr):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = perf_counter() - start
+            with self.lock:
+                setattr(self, attr, getattr(self, attr) + elapsed)
+
+    def to_dict(self):
+        return dict(
+            elapsed=self.elapsed,
+            dirs=self.dirs,
+            entries=self.entries,
+            entries_per_sec=self.entries / self.elapsed if self.elapsed else None,
+            fs_time=self.fs_time,
+            db_write_time=self.db_write_time,
+            db_read_time=self.db_read_time,
+            rows_written=self.rows_written,
+            stat=self.stat.to_dict(),
+            scandir=self.scandir.to_dict(),
+            slowest_dirs=[
+                dict(path=path, elapsed=elapsed, entries=entries)
+                for elapsed, path, entries in sorted(self.slowest, reverse=True)
+            ],
+        )
+
+    def print_summary(self):
+        d = self.to_dict()
+        rate = d['entries_per_sec']
+        err(f'Scanned {self.entries} entries in {self.dirs} dirs in {self.elapsed:.2f}s' + (f' ({rate:.0f} entries/s)' if rate else ''))
+        err(f'  filesystem: {self.fs_time:.2f}s (summed over listings), DB writes: {self.db_write_time:.2f}s ({self.rows_written} rows), DB reads: {self.db_read_time:.2f}s')
+        for name in [ 'stat', 'scandir' ]:
+            h = d[name]
+            if not h['count']:
+                continue
+            err(f'  {name} latency: {h["count"]} calls, mean {h["mean_us"]:.1f}µs, p50 {h["p50_us"]}µs, p90 {h["p90_us"]}µs, p99 {h["p99_us"]}µs, max {h["max_us"]:.0f}µs')
+            err('    ' + ', '.join( f'{label}: {count}' for label, count in h['buckets'].items() ))
+        if self.slowest:
+            err(f'  slowest {len(self.slowest)} directories:')
+            for s in d['slowest_dirs']:
+                err(f'    {s["elapsed"] * 1e3:10.1f}ms  {s["path"]} ({s["entries"]} entries)')
+
+    def write_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+
+def timer(stats, attr):
+    return nullcontext() if stats is None else stats.timer(attr)
@@ -0,0 +1,243 @@
+import numpy as np
+import pandas as pd
+from dateutil.tz import tzlocal
+
+FILE, DIR = 0, 1
+KINDS = [ 'file', 'dir' ]
+
+STR = np.dtypes.StringDType()
+SEP = np.array('/', dtype=STR)
+
+COLUMNS = dict(
+    parent=np.int64,
+    depth=np.int32,
+    name=np.int32,
+    kind=np.int8,
+    size=np.int64,
+    mtime=np.int64,
+    num_descendants=np.int64,
+)
+
+
+class Tree:
+    """Columnar in-memory file tree.
+
+    Node ``i`` has parent node ``parent[i]`` (``-1`` for the root, node 0; parents precede their children), ``depth``, name
+    ``names[name[i]]`` (names are interned; the root's is its full path), ``kind`` (``FILE`` or ``DIR``), and ``size``,
+    ``mtime`` (ns since the epoch) and ``num_descendants`` (aggregated over descendants, for directories).
+    """
+    def __init__(self, capacity=1024):
+        self.n = 0
+        self.names = []
+        self.name_ids = {}
+        self.arrays = { k: np.zeros(capacity, dtype) for k, dtype in COLUMNS.items() }
+
+    def __len__(self):
+        return self.n
+
+    def __getattr__(self, k):
+        if k in COLUMNS:
+            return self.arrays[k][:self.n]
+        raise AttributeError(k)
+
+    def intern(self, name):
+        if self.name_ids is None:
+            self.name_ids = { name: i for i, name in enumerate(self.names) }
+        name_id = self.name_ids.get(name)
+        if name_id is None:
+            name_id = self.name_ids[name] = len(self.names)
+            self.names.append(name)
+        return name_id
+
+    def add(self, parent, name, kind, size=0, mtime=0, num_descendants=0):
+        n = self.n
+        capacity = len(self.arrays['parent'])
+        if n == capacity:
+            self.arrays = { k: np.resize(arr, max(2 * capacity, 1024)) for k, arr in self.arrays.items() }
+        arrays = self.arrays
+        arrays['parent'][n] = parent
+        arrays['depth'][n] = 0 if parent < 0 else arrays['depth'][parent] + 1
+        arrays['name'][n] = self.intern(name)
+        arrays['kind'][n] = kind
+        arrays['size'][n] = size
+        arrays['mtime'][n] = mtime
+        arrays['num_descendants'][n] = num_descendants
+        self.n = n + 1
+        return n
+
+    def aggregate(self, dirs=None, children=None):
+        """Roll children's totals up into ``dirs`` (default: all directories), in place: each gets the sum of its
+        children's ``size`` and ``num_descendants`` added to its own, and the max of its own and its children's
+        ``mtime``.
+
+        Children not in ``dirs`` must already hold their totals. ``children`` (the nodes whose parents are in ``dirs``),
+        if the caller tracked them, saves finding them in a pass over the tree. Runs as one vectorized pass per level,
+        deepest first.
+        """
+        if dirs is None:
+            dirs = np.flatnonzero(self.kind == DIR)
+        dirs = np.asarray(dirs, dtype=np.int64)
+        if not len(dirs):
+            return
+        arrays = self.arrays
+        parent, depth = arrays['parent'], arrays['depth']
+        size, mtime, num_descendants = arrays['size'], arrays['mtime'], arrays['num_descendants']
+        if children is None:
+            is_target = np.zeros(self.n, dtype=bool)
+            is_target[dirs] = True
+            # Children follow their parents, so only nodes after the first target can be targets' children
+            lo = dirs.min() + 1
+            parents = parent[lo:self.n]
+            children = lo + np.flatnonzero((parents >= 0) & is_target[parents])
+        children = np.asarray(children, dtype=np.int64)
+        children = children[np.argsort(-depth[children], kind='stable')]
+        levels = np.split(children, np.flatnonzero(np.diff(depth[children])) + 1)
+        for level in levels:
+            if not len(level):
+                continue
+            parents = parent[level]
+            np.add.at(size, parents, size[level])
+            np.add.at(num_descendants, parents, num_descendants[level])
+            np.maximum.at(mtime, parents, mtime[level])
+
+    @classmethod
+    def from_arrays(cls, names, **columns):
+        """``Tree`` with the given ``COLUMNS`` (``name`` holding indices into ``names``)."""
+        tree = cls(capacity=0)
+        tree.n = len(columns['parent'])
+        tree.names = list(names)
+        tree.name_ids = None
+        tree.arrays = { k: np.array(columns[k], dtype=dtype) for k, dtype in COLUMNS.items() }
+        return tree
+
+    @classmethod
+    def from_keys(cls, root, keys, sizes, mtimes):
+        """Build a ``Tree`` of files at ``/``-delimited ``keys`` (relative to ``root``, which names the root node), and
+        the directories containing them, with aggregated totals.
+
+        Vectorized (with NumPy ``StringDType`` string ops): directories are found by repeatedly taking the unique
+        parents of the previous level's directories, and nodes are linked to their parents by looking up parent paths
+        in the directory index (``''`` is the root). Directories (in path order, so parents precede children) are
+        followed by files.
+        """
+        keys = np.asarray(keys, dtype=STR)
+        parents, seps, names = np.strings.rpartition(keys, SEP)
+        del seps
+        parent_ids, unique_parents = pd.factorize(parents)
+        del parents
+        levels = [ np.array([ '' ], dtype=STR) ]
+        level = unique_parents
+        while len(level):
+            levels.append(level)
+            level = level[level != '']
+            level = pd.unique(np.strings.rpartition(level, SEP)[0]) if len(level) else []
+        dirs = np.unique(np.concatenate(levels))
+        dir_parents, _, dir_names = np.strings.rpartition(dirs, SEP)
+        dir_index = pd.Index(dirs.astype(object))
+        dir_parents = dir_index.get_indexer(dir_parents.astype(object))
+        dir_parents[0] = -1
+        dir_depths = np.strings.count(dirs, SEP) + 1
+        dir_depths[0] = 0
+        dir_names[0] = root
+        file_parents = dir_index.get_indexer(unique_parents.astype(object))[parent_ids]
+        num_dirs, num_files = len(dirs), len(keys)
+        depths = np.strings.count(keys, SEP) + 1
+        del keys
+        name_ids, names = pd.factorize(np.concatenate([ dir_names, names ]))
+        tree = cls.from_arrays(
+            names,
+            parent=np.concatenate([ dir_parents, file_parents ]),
+            depth=np.concatenate([ dir_depths, depths ]),
+            name=name_ids,
+            kind=np.repeat([ DIR, FILE ], [ num_dirs, num_files ]),
+            size=np.concatenate([ np.zeros(num_dirs, dtype=np.int64), np.asarray(sizes, dtype=np.int64) ]),
+            mtime=np.concatenate([ np.zeros(num_dirs, dtype=np.int64), np.asarray(mtimes, dtype=np.int64) ]),
+            num_descendants=np.repeat([ 0, 1 ], [ num_dirs, num_files ]),
+        )
+        tree.aggregate()
+        return tree
+
+    @classmethod
+    def from_rows(cls, rows, root_name=None):
+        """Build a ``Tree`` from ``(id, parent_id, name, kind, size, mtime, num_descendants)`` rows, each row's parent
+        preceding it (cf. ``Node.tree_rows``); the first row is the root (named ``root_name``, if given), and rows whose
+        parent is missing are skipped."""
+        tree = cls()
+        dirs = {}
+        for id, parent_id, name, kind, size, mtime, num_descendants in rows:
+            if tree.n:
+                parent_node = dirs.get(parent_id)
+                if parent_node is None:
+                    continue
+            else:
+                parent_node = -1
+                if root_name is not None:
+                    name = root_name
+            kind = DIR if kind == 'dir' else FILE
+            node = tree.add(parent_node, name, kind, size, mtime, num_descendants)
+            if kind == DIR:
+                dirs[id] = node
+        return tree
+
+    def all_paths(self, n=None):
+        """Full paths of the first ``n`` nodes (default: all), built one level at a time."""
+        n = self.n if n is None else n
+        names = np.array(self.names, dtype=STR)[self.name[:n]]
+        parent, depth = self.parent[:n], self.depth[:n]
+        paths = np.empty(n, dtype=STR)
+        order = np.argsort(depth, kind='stable')
+        for level in np.split(order, np.flatnonzero(np.diff(depth[order])) + 1):
+            if not len(level):
+                continue
+            if depth[level[0]] == 0 or depth[level[0]] == 1 and paths[0] == '':
+                paths[level] = names[level]
+                continue
+            paths[level] = np.strings.add(np.strings.add(paths[parent[level]], SEP), names[level])
+        return paths.astype(object)
+
+    def paths(self, nodes):
+        """Full paths of ``nodes`` (parents' paths joined with ``/``)."""
+        memo = {}
+        parents = self.arrays['parent']
+        name_ids = self.arrays['name']
+        names = self.names
+        for node in nodes:
+            chain = []
+            cur = node
+            while cur >= 0 and cur not in memo:
+                chain.append(cur)
+                cur = int(parents[cur])
+            path = memo[cur] if cur >= 0 else None
+            for ancestor in reversed(chain):
+                name = names[name_ids[ancestor]]
+                path = name if path is None else f'{path}/{name}' if path else name
+                memo[ancestor] = path
+        return [ memo[node] for node in nodes ]
+
+    def largest(self, n):
+        """Indices of the ``n`` largest nodes, in increasing order of size."""
+        return np.argsort(self.size, kind='stable')[-n:]
+
+    def to_df(self, nodes=None):
+        """DataFrame of ``nodes`` (default: all), for rendering; ``mtime``s are (naive) local times."""
+        if nodes is None:
+            paths = self.all_paths()
+            nodes = np.arange(self.n)
+            parents = self.parent
+            parent_paths = np.where(parents >= 0, paths[parents], '')
+        else:
+            nodes = np.asarray(nodes)
+            paths = self.paths(nodes.tolist())
+            parents = self.parent[nodes]
+            has_parent = parents >= 0
+            parent_paths = np.full(len(nodes), '', dtype=object)
+            parent_paths[has_parent] = self.paths(parents[has_parent].tolist())
+        return pd.DataFrame({
+            'path': paths,
+            'name': np.array(self.names, dtype=object)[self.name[nodes]],
+            'kind': np.array(KINDS)[self.kind[nodes]],
+            'size': self.size[nodes],
+            'mtime': pd.to_datetime(self.mtime[nodes], unit='ns', utc=True).tz_convert(tzlocal()).tz_localize(None),
+            'num_descendants': self.num_descendants[nodes],
+            'parent': parent_paths,
+        })
@@ -23,4 +23,9 @@ setup(
         disk-tree=disk_tree.main:cli
     ''',
     install_requires = install_requires,
+    extras_require = {
+        # Reading ORC/Parquet S3 Inventory reports (`-I`)
+        'inventory': [ 'pyarrow' ],
+        'test': [ 'moto[s3]', 'pytest' ],
+    },
 )
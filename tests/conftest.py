@@ -0,0 +1,34 @@
+import pytest
+
+from disk_tree.db import init, migrate
+
+
+@pytest.fixture(scope='session')
+def Cache(tmp_path_factory):
+    """``Cache``, over a DB (and S3 listing caches) in a temporary directory, shared by all tests."""
+    db = init(str(tmp_path_factory.mktemp('db') / 'disk-tree.db'))
+    # `model` binds the DB when it's imported
+    from disk_tree import cache
+    db.create_all()
+    migrate()
+    with pytest.MonkeyPatch.context() as m:
+        m.setattr(cache, 'ROOT_DIR', str(tmp_path_factory.mktemp('root')))
+        yield cache.Cache
+
+
+@pytest.fixture
+def rows(Cache):
+    """Function returning the (non-placeholder) cached rows under a path, as sorted ``(path, kind, size,
+    num_descendants)`` tuples."""
+    from disk_tree.db import db
+    from disk_tree.model import is_placeholder, resolve, subtree
+
+    def rows(path):
+        node = resolve([ path ]).get(path)
+        if node is None:
+            return []
+        sub = subtree(node.id, path)
+        query = db.session.query(sub.c.path, sub.c.kind, sub.c.size, sub.c.num_descendants, sub.c.checked_at)
+        return sorted(row[:4] for row in query if not is_placeholder(row))
+
+    return rows
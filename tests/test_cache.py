@@ -0,0 +1,101 @@
+import pandas as pd
+import pytest
+
+from disk_tree import scan
+
+TTL = pd.to_timedelta(0)
+
+
+def touch(path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(path.name)
+
+
+def interrupt_after(monkeypatch, n):
+    """Interrupt scans (as if by Ctrl-C) after ``n`` directory listings."""
+    run = scan.Task.run
+    listings = []
+
+    def interrupted(self, *args, **kwargs):
+        if len(listings) == n:
+            raise KeyboardInterrupt
+        listings.append(self.path)
+        return run(self, *args, **kwargs)
+
+    monkeypatch.setattr(scan.Task, 'run', interrupted)
+
+
+@pytest.mark.parametrize('aio', [ False, True ])
+def test_interrupted_subdir_scan(Cache, tmp_path, monkeypatch, aio):
+    """Rows checkpointed (unnumbered) by an interrupted scan of a subdirectory are in its numbered ancestors' subtrees:
+    rendered with them, and expired with them."""
+    top = tmp_path / 'top'
+    touch(top / 'old' / 'f')
+    (top / 'old' / 'new').mkdir()
+    touch(top / 'keep' / 'k')
+    Cache(ttl=TTL).compute_file(str(top))
+
+    deep = top / 'old' / 'new' / 'deep'
+    for name in [ 'q1', 'q2', 'q3' ]:
+        touch(deep / name)
+    (deep / 'sub').mkdir()
+    with monkeypatch.context() as m:
+        # `new` and `deep` are listed (and `deep`'s files checkpointed), `sub` isn't
+        interrupt_after(m, 2)
+        with pytest.raises(KeyboardInterrupt):
+            Cache(ttl=TTL, aio=aio, checkpoint_interval=0).compute_file(str(deep.parent))
+
+    cache = Cache(ttl=TTL)
+    node = cache.node(str(top))
+    assert node.numbered and not node.ranged
+    names = [ row.name for row in node.tree_rows() ]
+    assert names[0] == 'top'
+    assert sorted(names) == sorted([ 'top', 'keep', 'k', 'old', 'f', 'new', 'deep', 'q1', 'q2', 'q3', 'sub' ])
+
+    for path in sorted((top / 'old').rglob('*'), reverse=True):
+        path.rmdir() if path.is_dir() else path.unlink()
+    (top / 'old').rmdir()
+    cache.compute_file(str(top))
+    assert cache.missing_parents().empty
+    node = cache.node(str(top))
+    assert node.ranged
+    assert sorted(row.name for row in node.tree_rows()) == [ 'k', 'keep', 'top' ]
+
+
+@pytest.mark.parametrize('incremental', [ False, True ])
+def test_remove_partially_scanned_subdir(Cache, tmp_path, incremental):
+    """A deleted directory that's only cached as a placeholder (the ancestor of an earlier scan's root) is expired with
+    its descendants."""
+    top = tmp_path / 'top'
+    touch(top / 'x' / 'y' / 'f')
+    touch(top / 'g')
+    Cache(ttl=TTL).compute_file(str(top / 'x' / 'y'))
+
+    for path in [ top / 'x' / 'y' / 'f', top / 'x' / 'y', top / 'x' ]:
+        path.rmdir() if path.is_dir() else path.unlink()
+    cache = Cache(ttl=TTL, incremental=incremental)
+    cache.compute_file(str(top))
+    assert cache.missing_parents().empty
+    assert sorted(row.name for row in cache.node(str(top)).tree_rows()) == [ 'g', 'top' ]
+    # Rescans (and fscks) find nothing left to expire
+    cache.compute_file(str(top), fsck=True)
+    assert cache.missing_parents().empty
+
+
+def test_scan_modes(Cache, rows, tmp_path):
+    """Sequential, thread-pool, and async scans of the same tree cache the same rows."""
+    top = tmp_path / 'top'
+    for path in [ 'a/0', 'a/b/1', 'a/b/c/2', 'a/b/c/3', 'd/4', 'e f/5', '6' ]:
+        touch(top / path)
+    (top / 'a' / 'empty').mkdir()
+    modes = dict(sequential={}, threads=dict(jobs=4), aio=dict(aio=True, concurrency=4))
+    scanned = {}
+    for mode, kwargs in modes.items():
+        root = tmp_path / mode
+        top.rename(root)
+        Cache(ttl=TTL, **kwargs).compute_file(str(root))
+        scanned[mode] = [ (path[len(str(root)):], *rest) for path, *rest in rows(str(root)) ]
+        root.rename(top)
+    assert scanned['sequential'][0] == ('', 'dir', 7, 7)
+    assert scanned['threads'] == scanned['sequential']
+    assert scanned['aio'] == scanned['sequential']
@@ -0,0 +1,126 @@
+import os
+import time
+import zlib
+
+import pandas as pd
+import pytest
+from pandas.testing import assert_frame_equal
+
+from disk_tree import listing_cache, s3
+
+
+def files(keys, start='2024-01-02 03:04:05'):
+    """Listing block of ``keys``, with distinct (whole-second) mtimes and sizes."""
+    n = len(keys)
+    return pd.DataFrame({
+        'mtime': pd.date_range(start, periods=n, freq='37s').astype('datetime64[ns]'),
+        'size': pd.Series(range(n), dtype='int64') * 1001,
+        'key': keys,
+    })
+
+
+KEYS = [
+    # Non-ASCII (multi-byte UTF-8, and outside the BMP)
+    'données/été/résumé.pdf',
+    'données/été/résumé.txt',
+    'データ/ファイル.csv',
+    'emoji/📁/🗂️.png',
+    # Prefixes of their predecessors (whole key shared)
+    'a/b/c/d',
+    'a/b/c',
+    'a/b',
+    'a',
+    # Longer than, and sharing nothing with, their predecessors
+    'z' * 300,
+    'a b/c d.txt',
+]
+
+
+@pytest.mark.parametrize('keys', [
+    KEYS,
+    [],
+    [ 'only/one/key' ],
+    [ '' ],
+    [ 'same', 'same' ],
+])
+def test_roundtrip(keys):
+    block = files(keys)
+    chunk = listing_cache.encode(block)
+    n, size = listing_cache.HEADER.unpack(chunk[:listing_cache.HEADER.size])
+    assert n == len(keys)
+    assert size == len(chunk) - listing_cache.HEADER.size
+    decoded = listing_cache.decode(n, zlib.decompress(chunk[listing_cache.HEADER.size:]))
+    assert_frame_equal(decoded, block)
+
+
+def test_shared_prefixes():
+    assert listing_cache.shared_prefixes(KEYS[:8]).tolist() == [ 0, 19, 0, 0, 0, 5, 3, 1 ]
+    assert listing_cache.shared_prefixes([]).tolist() == []
+
+
+def test_shared_prefixes_blocks(monkeypatch):
+    """Keys compared a few at a time (in overlapping blocks) match comparing them all at once."""
+    expected = listing_cache.shared_prefixes(KEYS)
+    monkeypatch.setattr(listing_cache, 'PREFIX_BLOCK', 1)
+    assert listing_cache.shared_prefixes(KEYS).tolist() == expected.tolist()
+    monkeypatch.setattr(listing_cache, 'PREFIX_BLOCK', 3 * len(max(KEYS, key=len)))
+    assert listing_cache.shared_prefixes(KEYS).tolist() == expected.tolist()
+
+
+def test_write_read(tmp_path):
+    path = str(tmp_path / 'bkt.lsz')
+    blocks = [ files(KEYS[:4]), files([]), files(KEYS[4:5]), files(KEYS[5:], start='2001-02-03 04:05:06') ]
+    listing_cache.write(path, iter(blocks))
+    assert not os.path.exists(f'{path}.tmp')
+    chunks = list(listing_cache.read(path))
+    # Empty blocks aren't written
+    assert len(chunks) == 3
+    expected = pd.concat([ block for block in blocks if len(block) ], ignore_index=True)
+    assert_frame_equal(pd.concat(chunks, ignore_index=True), expected)
+
+
+def test_read_invalid(tmp_path):
+    path = tmp_path / 'bkt.lsz'
+    path.write_bytes(b'2024-01-02 03:04:05       1001 a\n')
+    with pytest.raises(ValueError, match='not a listing cache'):
+        list(listing_cache.read(str(path)))
+
+
+@pytest.fixture
+def new_york(monkeypatch):
+    """Run in a local time zone other than UTC (UTC-5, in January)."""
+    monkeypatch.setenv('TZ', 'America/New_York')
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+def test_migrate(tmp_path, new_york):
+    block = files(KEYS)
+    txt_path = str(tmp_path / 'bkt.txt')
+    path = str(tmp_path / 'bkt.lsz')
+    with open(txt_path, 'w') as f:
+        f.write('\n'.join(s3.format_lines(block)) + '\n')
+    mtime_ns = 1_234_567_890_123_456_789
+    os.utime(txt_path, ns=(mtime_ns, mtime_ns))
+
+    listing_cache.migrate(txt_path, path)
+    assert not os.path.exists(txt_path)
+    # The listing's age (checked against the TTL) carries over
+    assert os.stat(path).st_mtime_ns == mtime_ns
+    # `aws s3 ls`' local times are converted to UTC
+    expected = block.assign(mtime=block['mtime'] + pd.Timedelta(hours=5))
+    assert_frame_equal(pd.concat(listing_cache.read(path), ignore_index=True), expected)
+
+
+def test_utc_mtimes(new_york):
+    mtimes = s3.utc_mtimes([ '2024-01-02T03:04:05.678Z', pd.Timestamp('2024-07-08 09:10:11', tz='UTC') ])
+    assert mtimes.tolist() == [ pd.Timestamp('2024-01-02 03:04:05'), pd.Timestamp('2024-07-08 09:10:11') ]
+    # Ambiguous (when DST ends) local times are taken to be in standard time
+    local = pd.Series(pd.to_datetime([ '2024-01-02 03:04:05', '2024-07-08 09:10:11', '2024-11-03 01:30:00' ]))
+    assert s3.local_to_utc(local).tolist() == [
+        pd.Timestamp('2024-01-02 08:04:05'),
+        pd.Timestamp('2024-07-08 13:10:11'),
+        pd.Timestamp('2024-11-03 06:30:00'),
+    ]
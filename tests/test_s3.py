@@ -0,0 +1,192 @@
+import json
+import os
+
+import boto3
+import pandas as pd
+import pytest
+
+from disk_tree import events, listing_cache, s3_list
+from disk_tree.s3_list import Lister, ShardedListing
+
+moto = pytest.importorskip('moto')
+
+TTL = pd.to_timedelta(0)
+KEYS = [
+    'a/0', 'a/1', 'a/2',
+    'b/c/0', 'b/c/1', 'b/c/d/0', 'b/e',
+    'f g/h+i.txt',
+    'top',
+    'z/0', 'z/1', 'z/2', 'z/3',
+]
+
+
+@pytest.fixture
+def client(monkeypatch):
+    for k, v in dict(AWS_ACCESS_KEY_ID='testing', AWS_SECRET_ACCESS_KEY='testing', AWS_DEFAULT_REGION='us-east-1').items():
+        monkeypatch.setenv(k, v)
+    monkeypatch.delenv('AWS_ENDPOINT_URL', raising=False)
+    # Small pages, so that listings span several pages (and shard boundaries fall within them)
+    monkeypatch.setattr(s3_list, 'PAGE_SIZE', 2)
+    with moto.mock_aws():
+        yield boto3.client('s3')
+
+
+def bucket(client, name, objects):
+    """Create bucket ``name``, with ``objects`` (keys, or ``{key: size}``)."""
+    client.create_bucket(Bucket=name)
+    if not isinstance(objects, dict):
+        objects = { key: i + 1 for i, key in enumerate(objects) }
+    for key, size in objects.items():
+        client.put_object(Bucket=name, Key=key, Body=b'x' * size)
+    return objects
+
+
+@pytest.mark.parametrize('prefix', [ '', 'b/' ])
+def test_lister(client, prefix):
+    bucket(client, 'lister', KEYS)
+    keys = [ obj['Key'] for _, contents, _ in Lister('lister', prefix, jobs=2, num_shards=4, client=client) for obj in contents ]
+    assert sorted(keys) == [ key for key in KEYS if key.startswith(prefix) ]
+
+
+def listed(path):
+    return pd.concat(listing_cache.read(path), ignore_index=True)['key'].tolist()
+
+
+def test_sharded_listing_resume(client, tmp_path):
+    bucket(client, 'sharded', KEYS)
+    path = str(tmp_path / 'sharded.lsz')
+    listing = ShardedListing(path, 'sharded', '', jobs=1, client=client, save_interval=0)
+    blocks = listing.blocks(num_keys=1)
+    next(blocks)
+    # Interrupted after the first page; its shards (and their tokens) are saved
+    blocks.close()
+    assert not os.path.exists(path)
+    assert ShardedListing(path, 'sharded', '', client=client).load() is not None
+
+    keys = [ key for files in ShardedListing(path, 'sharded', '', jobs=2, client=client).blocks() for key in files['key'] ]
+    assert sorted(keys) == KEYS
+    assert listed(path) == KEYS
+    assert not os.path.exists(f'{path}.shards')
+
+
+def test_sharded_listing_unsaved(client, tmp_path):
+    """Lines left by a listing that was killed before it saved its shards aren't resumed (or duplicated)."""
+    bucket(client, 'unsaved', KEYS)
+    path = str(tmp_path / 'unsaved.lsz')
+    os.makedirs(f'{path}.shards')
+    with open(f'{path}.shards/0.txt', 'w') as f:
+        f.write('2024-01-02 03:04:05          1 a/0\n')
+    list(ShardedListing(path, 'unsaved', '', jobs=1, client=client).blocks())
+    assert listed(path) == KEYS
+
+
+def test_refresh(Cache, client, rows):
+    """Relisting an expired bucket adds, changes and removes objects, matching a fresh listing of the same objects."""
+    objects = bucket(client, 'refresh', KEYS)
+    cache = Cache(ttl=TTL)
+    cache.compute_s3(url='s3://refresh', bucket='refresh', root_key='')
+    assert len([ row for row in rows('s3://refresh/') if row[1] == 'file' ]) == len(KEYS)
+
+    client.delete_object(Bucket='refresh', Key='b/c/d/0')
+    client.delete_object(Bucket='refresh', Key='top')
+    objects = { key: size for key, size in objects.items() if key not in [ 'b/c/d/0', 'top' ] }
+    objects.update({ 'a/1': 100, 'b/new': 3, 'y/z/0': 4 })
+    for key in [ 'a/1', 'b/new', 'y/z/0' ]:
+        client.put_object(Bucket='refresh', Key=key, Body=b'x' * objects[key])
+    cache.compute_s3(url='s3://refresh', bucket='refresh', root_key='')
+
+    bucket(client, 'fresh', objects)
+    Cache(ttl=TTL).compute_s3(url='s3://fresh', bucket='fresh', root_key='')
+    refreshed = [ (path[len('s3://refresh/'):], *rest) for path, *rest in rows('s3://refresh/') ]
+    fresh = [ (path[len('s3://fresh/'):], *rest) for path, *rest in rows('s3://fresh/') ]
+    assert refreshed == fresh
+    assert ('b/c/d', 'dir', 1, 1) not in refreshed
+    assert refreshed[0] == ('', 'dir', sum(objects.values()), len(objects))
+
+
+def record(bucket, key, name, sequencer, size=1):
+    obj = dict(key=key, sequencer=sequencer, **(dict(size=size) if name.startswith('ObjectCreated') else {}))
+    return dict(eventName=name, eventTime='2024-01-02T03:04:05.000Z', s3=dict(bucket=dict(name=bucket), object=obj))
+
+
+def test_events_order(Cache, client, rows, tmp_path, monkeypatch):
+    """Each key's latest event (by ``sequencer``) wins, even when an older one arrives later, in another batch/file."""
+    bucket(client, 'evts', { 'a/0': 1, 'a/1': 2, 'b/0': 4 })
+    Cache(ttl=pd.to_timedelta('1D')).compute_s3(url='s3://evts', bucket='evts', root_key='')
+    monkeypatch.setattr(events, 'BATCH_SIZE', 1)
+    docs = [
+        # Newer removal, then an older creation (dropped)
+        [ record('evts', 'a/0', 'ObjectRemoved:Delete', '0B'), record('evts', 'a/0', 'ObjectCreated:Put', '0A', 8) ],
+        # Older creation, then a newer one (in a later file)
+        [ record('evts', 'b/new', 'ObjectCreated:Put', '01', 16) ],
+        [ record('evts', 'b/new', 'ObjectCreated:Put', '02', 32), record('evts', 'a/1', 'ObjectRemoved:Delete', '0000000000000000FF') ],
+        # Older than the removal of `a/1` above (a shorter sequencer, compared after zero-padding)
+        [ record('evts', 'a/1', 'ObjectCreated:Put', '00000000000000000F', 64) ],
+    ]
+    paths = []
+    for i, doc in enumerate(docs):
+        path = tmp_path / f'{i}.json'
+        path.write_text(json.dumps(dict(Records=doc)))
+        paths.append(str(path))
+    Cache(ttl=pd.to_timedelta('1D')).compute_s3_events(url='s3://evts', bucket='evts', root_key='', paths=paths)
+    assert rows('s3://evts/') == [
+        ('s3://evts/', 'dir', 36, 2),
+        ('s3://evts/b', 'dir', 36, 2),
+        ('s3://evts/b/0', 'file', 4, 1),
+        ('s3://evts/b/new', 'file', 32, 1),
+    ]
+
+
+def inventory(dir, files, created):
+    """Write a CSV S3 Inventory (``manifest.json`` and data ``files``, each a list of ``(key, size)``) to ``dir``."""
+    dir.mkdir(parents=True)
+    for name, objects in files.items():
+        with open(dir / name, 'w') as f:
+            for key, size in objects:
+                # Keys are URL-encoded
+                key = key.replace('+', '%2B').replace(' ', '+')
+                f.write(f'"inv","{key}","{size}","2024-01-02T03:04:05.000Z","true"\n')
+    manifest = dict(
+        sourceBucket='inv',
+        destinationBucket='arn:aws:s3:::inventories',
+        fileFormat='CSV',
+        fileSchema='Bucket, Key, Size, LastModifiedDate, IsLatest',
+        creationTimestamp=str(created),
+        files=[ dict(key=f'inv/inventory/data/{name}') for name in files ],
+    )
+    path = dir / 'manifest.json'
+    path.write_text(json.dumps(manifest))
+    return str(path)
+
+
+def test_inventory(Cache, rows, tmp_path):
+    path = inventory(tmp_path / '1', { '0.csv': [ ('a/0', 1), ('a/1', 2), ('f g/h+i.txt', 4), ('top', 8) ] }, 1_700_000_000_000)
+    Cache(ttl=TTL).compute_s3_inventory(url='s3://inv', bucket='inv', root_key='', manifest_path=path)
+    assert rows('s3://inv/') == [
+        ('s3://inv/', 'dir', 15, 4),
+        ('s3://inv/a', 'dir', 3, 2),
+        ('s3://inv/a/0', 'file', 1, 1),
+        ('s3://inv/a/1', 'file', 2, 1),
+        ('s3://inv/f g', 'dir', 4, 1),
+        ('s3://inv/f g/h+i.txt', 'file', 4, 1),
+        ('s3://inv/top', 'file', 8, 1),
+    ]
+
+    expected = [
+        ('s3://inv/', 'dir', 50, 3),
+        ('s3://inv/a', 'dir', 17, 2),
+        ('s3://inv/a/0', 'file', 1, 1),
+        ('s3://inv/a/1', 'file', 16, 1),
+        ('s3://inv/z', 'dir', 33, 1),
+        ('s3://inv/z/0', 'file', 33, 1),
+    ]
+    # Diffed against the cached rows (data files in key order)…
+    files = { '0.csv': [ ('a/0', 1), ('a/1', 16) ], '1.csv': [ ('z/0', 33) ] }
+    path = inventory(tmp_path / '2', files, 1_700_000_100_000)
+    Cache(ttl=TTL).compute_s3_inventory(url='s3://inv', bucket='inv', root_key='', manifest_path=path)
+    assert rows('s3://inv/') == expected
+    # …or replacing them (data files out of key order)
+    files = { '0.csv': [ ('z/0', 33) ], '1.csv': [ ('a/0', 1), ('a/1', 16) ] }
+    path = inventory(tmp_path / '3', files, 1_700_000_200_000)
+    Cache(ttl=TTL).compute_s3_inventory(url='s3://inv', bucket='inv', root_key='', manifest_path=path)
+    assert rows('s3://inv/') == expected